@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for DocL-NER.
+
+usage:
+    python benchmark.py <benchmark> --model_dir <model dir> [--raw_dir <documents>] [other main.py options]
+
+The model and the dataset vocabulary are loaded from --model_dir in the same way as `main.py --status decode`,
+the documents in --raw_dir (CoNLL test set by default) are used as benchmark inputs.
+"""
+from __future__ import print_function
+
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from main import get_parser, batchify_with_label, load_model, set_cpu_threads, set_telemetry, evaluate, decode_online
+from model.seqmodel import SeqModel
+from model.transformer import MultiHeadAttn
+from tests.rel_shift import rel_term_shift
+from utils.data import Data
+
+
+def load_data(args):
+    data = Data()
+    data.HP_gpu = torch.cuda.is_available()
+    data.load(args.model_dir + "/data.dset")
+    data.read_config(args)
+    set_cpu_threads(data)
+    set_telemetry(data)
+    data.generate_instance('raw')
+    return data
+
+
+def time_docs(data, model, instances, warmup=5):
+    '''
+    decode documents one by one
+    :return: latency of each document in seconds
+    '''
+    model.eval()
+    latency = []
+    with torch.no_grad():
+        for i, doc in enumerate(instances):
+            batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask, doc_idx, word_idx = batchify_with_label(
+                [doc], data.HP_gpu, True)
+            start = time.time()
+            model(batch_word, batch_features, batch_wordlen, batch_char, batch_charlen, batch_charrecover, mask,
+                  doc_idx, word_idx)
+            if data.HP_gpu:
+                torch.cuda.synchronize()
+            if i >= warmup:
+                latency.append(time.time() - start)
+    return latency
+
+
+def report_latency(name, latency):
+    latency = np.asarray(latency) * 1000
+    print("%-12s docs: %d, mean: %.2f ms, p50: %.2f ms, p95: %.2f ms, speed: %.2f doc/s" % (
+        name, len(latency), latency.mean(), np.percentile(latency, 50), np.percentile(latency, 95),
+        1000 / latency.mean()))
+
+
+def bench_compile(args):
+    '''latency of eager / TorchScript / torch.compile inference'''
+    for mode in ['none', 'script', 'compile']:
+        args.compile = mode
+        data = load_data(args)
+        model = load_model(data)
+        report_latency(mode, time_docs(data, model, data.raw_Ids))
+
+
+def bench_evaluate(args):
+    '''docs/s of `evaluate` on the raw documents'''
+    data = load_data(args)
+    model = load_model(data)
+    data.test_Ids = data.raw_Ids
+    start = time.time()
+    evaluate(data, model, 'test')
+    print("RESULT docs/s: %.4f" % (len(data.raw_Ids) / (time.time() - start)))
+
+
+def bench_threads(args):
+    '''docs/s of `evaluate` for each intra-op / inter-op thread setting, every setting runs in a fresh process'''
+    argv = sub_argv(args.benchmark, 'evaluate',
+                    ['--sweep_threads', '--sweep_interop_threads', '--num_threads', '--num_interop_threads'])
+    results = []
+    for num_threads in parse_int_list(args.sweep_threads):
+        for num_interop_threads in parse_int_list(args.sweep_interop_threads):
+            cmd = argv + ['--num_threads', str(num_threads), '--num_interop_threads', str(num_interop_threads)]
+            output = subprocess.check_output(cmd, universal_newlines=True)
+            speed = float(re.findall(r"RESULT docs/s: ([0-9.]+)", output)[-1])
+            print("threads: %d, interop threads: %d, speed: %.2f doc/s" % (num_threads, num_interop_threads, speed))
+            results.append((speed, num_threads, num_interop_threads))
+    best = max(results)
+    print("best setting: --num_threads %d --num_interop_threads %d (%.2f doc/s)" % (best[1], best[2], best[0]))
+
+
+def train_batches(data, args):
+    '''the --bench_docs longest raw documents in batches of --batch_size documents'''
+    docs = sorted(data.raw_Ids, key=lambda doc: -sum(len(sent[0]) for sent in doc))[:int(args.bench_docs)]
+    return [batchify_with_label(docs[i:i + data.HP_batch_size], data.HP_gpu, True)
+            for i in range(0, len(docs), data.HP_batch_size)]
+
+
+def train_step(model, batch, backward=True):
+    batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask, doc_idx, word_idx = batch
+    loss, _ = model.neg_log_likelihood_loss(batch_word, batch_features, batch_wordlen, batch_char, batch_charlen,
+                                            batch_charrecover, batch_label, mask, doc_idx, word_idx)
+    if backward:
+        loss.backward()
+    return loss
+
+
+def saved_activations(model, batch):
+    '''bytes of the tensors other than parameters that the forward pass keeps for the backward pass'''
+    params = set(p.data_ptr() for p in model.parameters())
+    saved = {}
+
+    def pack(tensor):
+        if tensor.data_ptr() not in params:
+            saved[tensor.data_ptr()] = max(saved.get(tensor.data_ptr(), 0), tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        train_step(model, batch, backward=False)
+    return sum(saved.values())
+
+
+def bench_trainstep(args):
+    '''step time and peak memory of training steps (forward + backward) on the longest documents'''
+    data = load_data(args)
+    model = SeqModel(data)
+    model.train()
+    batches = train_batches(data, args)
+    train_step(model, batches[0])  # warm up
+    model.zero_grad()
+    if data.HP_gpu:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for batch in batches:
+        train_step(model, batch)
+        model.zero_grad()
+    if data.HP_gpu:
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # KB on linux
+    step = (time.time() - start) * 1000 / len(batches)
+    saved = max(saved_activations(model, batch) for batch in batches) / 2 ** 20
+    print("RESULT step: %.4f ms, peak: %.4f MB, saved activations: %.4f MB" % (step, peak, saved))
+
+
+def bench_checkpoint(args):
+    '''
+    step time, peak memory (CUDA allocations, or process RSS on CPU) and activations kept for the backward pass of
+    training with and without --checkpoint_activations, each setting runs in a fresh process; and the max difference
+    of their gradients
+    '''
+    argv = sub_argv(args.benchmark, 'trainstep', ['--checkpoint_activations'])
+    for flag in ['False', 'True']:
+        output = subprocess.check_output(argv + ['--checkpoint_activations', flag], universal_newlines=True)
+        step, peak, saved = re.findall(
+            r"RESULT step: ([0-9.]+) ms, peak: ([0-9.]+) MB, saved activations: ([0-9.]+) MB", output)[-1]
+        print("checkpoint_activations: %s, step: %.2f ms, peak %s: %.2f MB, saved activations: %.2f MB" % (
+            flag, float(step), 'allocated' if torch.cuda.is_available() else 'RSS', float(peak), float(saved)))
+
+    data = load_data(args)
+    model = SeqModel(data)
+    model.train()
+    batch = train_batches(data, args)[0]
+    grads = {}
+    for flag in [False, True]:
+        model.mcmodel.checkpoint = model.encoder.checkpoint = flag
+        model.zero_grad()
+        torch.manual_seed(0)
+        train_step(model, batch)
+        grads[flag] = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    print("max abs gradient diff: %.3g" % max((a - b).abs().max().item() for a, b in zip(grads[False], grads[True])))
+
+
+def bench_mc(args):
+    '''score, docs/s and average samples of fixed and adaptive MC sampling, run with --raw_dir <dev set>'''
+    data = load_data(args)
+    model = load_model(data)
+    data.test_Ids = data.raw_Ids
+    for tol in parse_float_list(args.sweep_mc_tol):
+        model.mc_tol = tol if tol > 0 else None
+        model.mcmodel.mc_stats = [0, 0]
+        start = time.time()
+        score, _ = evaluate(data, model, 'test')
+        speed = len(data.raw_Ids) / (time.time() - start)
+        nsample, calls = model.mcmodel.mc_stats
+        print("mc_tol: %s, score: %.4f, speed: %.2f doc/s, average samples: %.2f / %d" % (
+            tol if tol > 0 else 'fixed', score, speed, float(nsample) / max(calls, 1), model.nsamples))
+
+
+def bench_uncertainty(args):
+    '''score and docs/s of MC dropout and moment propagation uncertainty, run with --raw_dir <dev set>'''
+    data = load_data(args)
+    model = load_model(data)
+    data.test_Ids = data.raw_Ids
+    for mode in ['mc', 'moment']:
+        model.uncertainty_mode = mode
+        start = time.time()
+        score, _ = evaluate(data, model, 'test')
+        print("uncertainty_mode: %s, score: %.4f, speed: %.2f doc/s" % (
+            mode, score, len(data.raw_Ids) / (time.time() - start)))
+
+
+def bench_threshold(args):
+    '''docs/s with and without routing only uncertain sentences to model2 for each --sweep_threshold'''
+    data = load_data(args)
+    model = load_model(data)
+    data.test_Ids = data.raw_Ids
+    for threshold in parse_float_list(args.sweep_threshold):
+        model.threshold = threshold
+        speed = {}
+        for skip in [False, True]:
+            model.skip_stage2 = skip
+            model.stage2_stats = [0, 0, 0, 0]
+            start = time.time()
+            score, _ = evaluate(data, model, 'test')
+            speed[skip] = len(data.raw_Ids) / (time.time() - start)
+        run, total, sent_run, sent_total = model.stage2_stats
+        print("threshold: %.3f, score: %.4f, model2 skipped: %.2f%% batches, %.2f%% sentences, "
+              "speed: %.2f -> %.2f doc/s (x%.2f)" % (
+                  threshold, score, 100. * (total - run) / max(total, 1),
+                  100. * (sent_total - sent_run) / max(sent_total, 1), speed[False], speed[True],
+                  speed[True] / speed[False]))
+
+
+def bench_share(args):
+    '''parameter memory and latency of separate and shared word representations (randomly initialized models)'''
+    for share in [False, True]:
+        data = load_data(args)  # SeqModel grows data.label_alphabet_size under crf, every model gets fresh data
+        data.share_wordrep = share
+        model = SeqModel(data)
+        params = dict((id(p), p) for p in model.parameters())
+        m2_params = dict((id(p), p) for p in model.get_m2_params())
+        assert not set(m2_params) & set(id(p) for p in model.mcmodel.parameters())
+        size = sum(p.numel() * p.element_size() for p in params.values()) / 2 ** 20
+        report_latency("share: %s" % share, time_docs(data, model, data.raw_Ids))
+        print("share: %s, parameters: %.2f MB" % (share, size))
+
+
+def bench_memory(args):
+    '''latency and allocations of Memory.put with fresh and reused buffers on the --bench_docs longest documents'''
+    data = load_data(args)
+    model = load_model(data)
+    instances = sorted(data.raw_Ids, key=lambda doc: -sum(len(sent[0]) for sent in doc))[:int(args.bench_docs)]
+    print("documents: %d, words: %d - %d" % (len(instances), sum(len(sent[0]) for sent in instances[-1]),
+                                             sum(len(sent[0]) for sent in instances[0])))
+    for reuse in [False, True]:
+        model.memory.reuse_buffers = reuse
+        model.memory.buf_h, model.memory.buf_l = None, None
+        model.memory.buffer_stats = [0, 0]
+        if data.HP_gpu:
+            torch.cuda.reset_peak_memory_stats()
+            allocs = torch.cuda.memory_stats().get('allocation.all.allocated', 0)
+        report_latency("reuse: %s" % reuse, time_docs(data, model, instances, warmup=3))
+        allocations, puts = model.memory.buffer_stats
+        print("reuse: %s, memory buffer allocations: %d / %d puts" % (reuse, allocations, 2 * puts))
+        if data.HP_gpu:
+            print("reuse: %s, cuda allocations: %d, peak: %.2f MB" % (
+                reuse, torch.cuda.memory_stats().get('allocation.all.allocated', 0) - allocs,
+                torch.cuda.max_memory_allocated() / 2 ** 20))
+
+
+def bench_topk(args):
+    '''score and docs/s of reading the --sweep_memory_topk most similar of the --max_read_memory neighbours'''
+    data = load_data(args)
+    model = load_model(data)
+    data.test_Ids = data.raw_Ids
+    for topk in parse_int_list(args.sweep_memory_topk):
+        model.memory.topk = topk
+        start = time.time()
+        score, _ = evaluate(data, model, 'test')
+        print("memory_topk: %s, score: %.4f, speed: %.2f doc/s" % (
+            topk if topk > 0 else 'all %s' % data.HP_max_read_memory, score, len(data.raw_Ids) / (time.time() - start)))
+
+
+def bench_relattn(args):
+    '''time and memory of relative-position attention through the shifted L x 2L scores and in direct L x L form'''
+    data = load_data(args)
+    model = load_model(data)
+    attn = model.encoder.layers[0].self_attn_hh
+    attn.eval()
+    device = attn.r_w_bias.device
+    bsz, n_head, head_dim = int(args.bench_batch), attn.n_head, attn.head_dim
+    for max_len in parse_int_list(args.sweep_len):
+        x = torch.randn(bsz, max_len, n_head * head_dim, device=device)
+        mask = torch.ones(bsz, max_len, max_len, dtype=torch.long, device=device)
+        outputs = {}
+        for name, rel_term in [('shift', lambda q, r, AC=None: rel_term_shift(attn, q, r, AC)),
+                               ('direct', attn._rel_term)]:
+            attn.__dict__['_rel_term'] = rel_term
+            if data.HP_gpu:
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.time()
+            for _ in range(int(args.bench_repeat)):
+                with torch.no_grad():
+                    outputs[name] = attn(x, x, mask)[0]
+            if data.HP_gpu:
+                torch.cuda.synchronize()
+                memory = "peak: %.2f MB" % (torch.cuda.max_memory_allocated() / 2 ** 20)
+            else:
+                # floats of the relative-position intermediates: B_, B_ + D_ and the padded copy in shift
+                # for shift, the gathered r rows and one query chunk of scores for direct
+                chunk = attn.query_chunk if attn.query_chunk > 0 else max_len
+                floats = (3 * bsz * n_head * max_len * 2 * max_len if name == 'shift' else
+                          chunk * max_len * head_dim + bsz * n_head * chunk * max_len)
+                memory = "relative-position intermediates: %.2f MB" % (floats * x.element_size() / 2 ** 20)
+            print("len: %d, %-6s time: %.2f ms, %s" % (
+                max_len, name, (time.time() - start) * 1000 / int(args.bench_repeat), memory))
+        del attn.__dict__['_rel_term']
+        print("len: %d, max abs diff: %.3g" % (max_len, (outputs['shift'] - outputs['direct']).abs().max().item()))
+
+
+def bench_sdpa(args):
+    '''
+    time of the naive and the memory attention with the math and the fused (scaled_dot_product_attention) kernel,
+    the max difference of their outputs, and whether the model labels agree
+    '''
+    data = load_data(args)
+    model = load_model(data)
+    model.eval()
+    device = model.hidden2tag.weight.device
+    bsz, repeat = int(args.bench_batch), int(args.bench_repeat)
+    naive = MultiHeadAttn(data.d_model, data.HP_nhead, scale=True).to(device).eval()
+    for max_len in parse_int_list(args.sweep_len):
+        x = torch.randn(bsz, max_len, data.d_model, device=device)
+        lengths = torch.randint(1, max_len + 1, (bsz,), device=device)
+        mask = torch.arange(max_len, device=device)[None, :] < lengths[:, None]
+        mask = mask[:, None, :].expand(bsz, max_len, max_len)
+        outputs = {}
+        for attn_impl in ['math', 'sdpa']:
+            naive.attn_impl = attn_impl
+            start = time.time()
+            with torch.no_grad():
+                for _ in range(repeat):
+                    outputs[attn_impl] = naive(x, x, mask)[0]
+            if data.HP_gpu:
+                torch.cuda.synchronize()
+            print("naive len: %d, %-4s time: %.2f ms" % (max_len, attn_impl, (time.time() - start) * 1000 / repeat))
+        print("naive len: %d, max abs diff: %.3g" % (max_len, (outputs['math'] - outputs['sdpa']).abs().max().item()))
+
+    if not model.use_memory:
+        return
+    attn = model.memory.attn
+    num, k_len = bsz * 32, data.HP_max_read_memory
+    q = torch.randn(num, 1, data.d_model, device=device)
+    k = torch.randn(num, k_len, data.d_model, device=device)
+    v = torch.randn(num, k_len, data.d_model, device=device)
+    mask = torch.rand(num, 1, k_len, device=device) < 0.5
+    found = mask.any(-1).reshape(-1)  # rows without any key are replaced by the default entry in Memory.get
+    outputs = {}
+    for attn_impl in ['math', 'sdpa']:
+        attn.attn_impl = attn_impl
+        start = time.time()
+        with torch.no_grad():
+            for _ in range(repeat):
+                outputs[attn_impl] = attn.attend(q, k, v, mask)
+        if data.HP_gpu:
+            torch.cuda.synchronize()
+        print("memory %d x %d keys, %-4s time: %.2f ms" % (num, k_len, attn_impl, (time.time() - start) * 1000 / repeat))
+    print("memory max abs diff: %.3g" % max((a[found] - b[found]).abs().max().item()
+                                             for a, b in zip(outputs['math'], outputs['sdpa'])))
+
+    preds = {}
+    for attn_impl in ['math', 'sdpa']:
+        attn.attn_impl = attn_impl
+        report_latency("attn: %s" % attn_impl, time_docs(data, model, data.raw_Ids))
+        preds[attn_impl] = []
+        with torch.no_grad():
+            for doc in data.raw_Ids[:int(args.bench_docs)]:
+                batch = batchify_with_label([doc], data.HP_gpu, True)
+                torch.manual_seed(0)
+                preds[attn_impl].append(model(*(batch[:3] + batch[4:7] + batch[8:])))
+    same = all(torch.equal(a, b) for a, b in zip(preds['math'], preds['sdpa']))
+    print("identical labels on %d documents: %s" % (len(preds['sdpa']), same))
+
+
+def bench_earlyexit(args):
+    '''
+    score, docs/s and average number of model2 encoder layers run with early exit (--early_exit_threshold) for each
+    --sweep_exit_threshold, against running all layers
+    '''
+    data = load_data(args)
+    model = load_model(data)
+    if model.exit_heads is None:
+        print("the model has no exit heads, train it with --early_exit True")
+        return
+    data.test_Ids = data.raw_Ids
+    model.early_exit_threshold = 0
+    evaluate(data, model, 'test')  # warm up
+    base = None
+    for threshold in [0] + parse_float_list(args.sweep_exit_threshold):
+        model.early_exit_threshold = threshold
+        model.exit_stats = [0, 0]
+        torch.manual_seed(int(args.seed))  # same MC samples for every threshold
+        start = time.time()
+        score, _ = evaluate(data, model, 'test')
+        elapsed = time.time() - start
+        if base is None:
+            base = elapsed
+        layers, sents = model.exit_stats
+        print("early_exit_threshold: %.3f, score: %.4f, layers per model2 sentence: %.2f / %d, speed: %.2f doc/s, "
+              "latency saved: %.1f%%" % (threshold, score, float(layers) / max(sents, 1), len(model.encoder.layers),
+                                         len(data.raw_Ids) / elapsed, 100. * (base - elapsed) / base))
+
+
+def bench_varlen(args):
+    '''latency of the padded and the bucketed (--varlen_encoder) model2 encoder, and whether their labels agree'''
+    data = load_data(args)
+    model = load_model(data)
+    model.eval()
+    lengths = np.asarray([len(sent[0]) for doc in data.raw_Ids for sent in doc])
+    print("sentence length: mean %.1f, p50 %d, p95 %d, max %d" % (
+        lengths.mean(), np.percentile(lengths, 50), np.percentile(lengths, 95), lengths.max()))
+    model.threshold = -1  # all sentences run model2
+    preds = {}
+    for varlen in [False, True]:
+        model.varlen_encoder = model.encoder.varlen = varlen
+        report_latency("varlen: %s" % varlen, time_docs(data, model, data.raw_Ids))
+        preds[varlen] = []
+        with torch.no_grad():
+            for doc in data.raw_Ids[:int(args.bench_docs)]:
+                batch = batchify_with_label([doc], data.HP_gpu, True)
+                torch.manual_seed(0)
+                preds[varlen].append(model(*(batch[:3] + batch[4:7] + batch[8:])))
+    same = all(torch.equal(a, b) for a, b in zip(preds[False], preds[True]))
+    print("identical labels on %d documents: %s" % (len(preds[True]), same))
+
+
+def bench_online(args):
+    '''first-output latency, document latency and score of online decoding for each --sweep_online_delay'''
+    data = load_data(args)
+    model = load_model(data)
+    data.test_Ids = data.raw_Ids
+    data.online_delay = -1
+    score, _ = evaluate(data, model, 'test')
+    latency = np.asarray(time_docs(data, model, data.raw_Ids)) * 1000
+    print("whole document: score: %.4f, first output: %.2f ms, document: %.2f ms" % (
+        score, latency.mean(), latency.mean()))
+    for delay in parse_int_list(args.sweep_online_delay):
+        for revise in [False, True]:
+            data.online_delay, data.online_revise = delay, revise
+            first, latency = [], []
+            with torch.no_grad():
+                for doc in data.raw_Ids:
+                    start = time.time()
+                    for i, sent in enumerate(decode_online(data, model, doc)):
+                        if i == 0:
+                            first.append(time.time() - start)
+                    latency.append(time.time() - start)
+            score, _ = evaluate(data, model, 'test')
+            print("online_delay: %d, revise: %s, score: %.4f, first output: %.2f ms, document: %.2f ms" % (
+                delay, revise, score, np.mean(first) * 1000, np.mean(latency) * 1000))
+
+
+def sub_argv(current, benchmark, drop_options):
+    '''command line running `benchmark` with the options of this process, except `drop_options`'''
+    argv = [sys.executable, sys.argv[0], benchmark]
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        if args[i] in drop_options:
+            i += 2
+            continue
+        if args[i] != current or (i > 0 and args[i - 1].startswith('--')):
+            argv.append(args[i])
+        i += 1
+    return argv
+
+
+def parse_int_list(value):
+    return [int(x) for x in str(value).split(',') if x.strip()]
+
+
+def parse_float_list(value):
+    return [float(x) for x in str(value).split(',') if x.strip()]
+
+
+BENCHMARKS = {
+    'checkpoint': bench_checkpoint,
+    'compile': bench_compile,
+    'earlyexit': bench_earlyexit,
+    'evaluate': bench_evaluate,
+    'mc': bench_mc,
+    'memory': bench_memory,
+    'online': bench_online,
+    'relattn': bench_relattn,
+    'sdpa': bench_sdpa,
+    'share': bench_share,
+    'threads': bench_threads,
+    'threshold': bench_threshold,
+    'topk': bench_topk,
+    'trainstep': bench_trainstep,
+    'uncertainty': bench_uncertainty,
+    'varlen': bench_varlen,
+}
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--sweep_threads', default='1,2,4', help='intra-op thread counts swept by `threads`')
+    parser.add_argument('--sweep_interop_threads', default='1', help='inter-op thread counts swept by `threads`')
+    parser.add_argument('--sweep_threshold', default='0.05,0.15,0.3,0.5',
+                        help='thresholds swept by `threshold`')
+    parser.add_argument('--sweep_mc_tol', default='0,0.05,0.02,0.01,0.005',
+                        help='adaptive MC tolerances swept by `mc`, 0 means fixed nsample')
+    parser.add_argument('--sweep_exit_threshold', default='0.99,0.95,0.9',
+                        help='early_exit_threshold swept by `earlyexit`')
+    parser.add_argument('--sweep_online_delay', default='0,2,8', help='sentence delays swept by `online`')
+    parser.add_argument('--sweep_memory_topk', default='0,1,2,5', help='memory_topk swept by `topk`, 0 reads all')
+    parser.add_argument('--sweep_len', default='25,50,100,150,200,250', help='sentence lengths swept by `relattn` and `sdpa`')
+    parser.add_argument('--bench_batch', default=32, help='number of sentences in a batch of `relattn` and `sdpa`')
+    parser.add_argument('--bench_repeat', default=10, help='number of timed repetitions of `relattn` and `sdpa`')
+    parser.add_argument('--bench_docs', default=50, help='number of documents used by `memory` / `checkpoint` (longest) and `varlen` / `sdpa` (label check)')
+    args = parser.parse_args()
+    torch.manual_seed(int(args.seed))
+    BENCHMARKS[args.benchmark](args)
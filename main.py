@@ -16,6 +16,9 @@ from model.seqmodel import SeqModel
 from utils.data import Data
 from utils.metric import get_ner_fmeasure
 from utils.optimizer import *
+from utils import telemetry
+from utils.telemetry import phase
+from utils.stage1_cache import Stage1Cache
 
 try:
     import cPickle as pickle
@@ -75,7 +78,29 @@ def lr_decay(optimizer, epoch, decay_rate, init_lr):
     return optimizer
 
 
-def evaluate(data, model, name):
+def set_telemetry(data):
+    if data.telemetry_path:
+        telemetry.enable(data.telemetry_path, data.HP_gpu)
+
+
+def set_cpu_threads(data):
+    if data.cpu_affinity:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, data.cpu_affinity)
+            print("CPU affinity is set as:", sorted(os.sched_getaffinity(0)))
+        else:
+            print("Warning: CPU affinity is not supported on this platform, ignored.")
+    if data.num_threads > 0:
+        torch.set_num_threads(data.num_threads)
+    if data.num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(data.num_interop_threads)
+        except RuntimeError as e:
+            print("Warning: cannot set inter-op threads (%s), ignored." % e)
+    print("Intra-op threads: %d, inter-op threads: %d" % (torch.get_num_threads(), torch.get_num_interop_threads()))
+
+
+def evaluate(data, model, name, stage1_cache=None):
     if name == "train":
         instances = data.train_Ids
     elif name == "dev":
@@ -105,12 +130,31 @@ def evaluate(data, model, name):
             instance = instances[start:end]
             if not instance:
                 continue
-            batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask,  doc_idx, word_idx = batchify_with_label(
-                instance, data.HP_gpu, True)
-            tag_seq = model(batch_word, batch_features, batch_wordlen,
-                                                     batch_char,
-                                                     batch_charlen, batch_charrecover,
-                                                     mask,  doc_idx, word_idx)
+            telemetry.begin_step()
+            if data.online_delay >= 0:
+                with phase('forward'):
+                    decoded = [sent for doc in instance for sent in online_results(data, model, doc)]
+                telemetry.end_step(sum(int(sent[1].sum()) for sent in decoded), mode=name, batch=batch_id,
+                                   docs=len(instance))
+                for tag_seq, mask, batch_label, batch_wordrecover in decoded:
+                    pred_labels, gold_label = recover_label(tag_seq, batch_label, mask, data.label_alphabet,
+                                                            batch_wordrecover)
+                    gold_results += gold_label
+                    pred_results += pred_labels
+                continue
+            with phase('batchify_with_label'):
+                batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask,  doc_idx, word_idx = batchify_with_label(
+                    instance, data.HP_gpu, True)
+            stage1 = None
+            if stage1_cache is not None:
+                with phase('stage1_cache'):
+                    stage1 = stage1_cache.get(doc_idx, word_idx, mask)
+            with phase('forward'):
+                tag_seq = model(batch_word, batch_features, batch_wordlen,
+                                                         batch_char,
+                                                         batch_charlen, batch_charrecover,
+                                                         mask,  doc_idx, word_idx, stage1)
+            telemetry.end_step(int(mask.sum()), mode=name, batch=batch_id, docs=len(instance))
 
             pred_labels, gold_label = recover_label(tag_seq, batch_label, mask, data.label_alphabet, batch_wordrecover)
             gold_results += gold_label
@@ -237,10 +281,17 @@ def train(data):
     # print(model)
     print("pytorch total params: %d" % pytorch_total_params)
 
+    ## model 2 only: load and freeze model1, read its outputs from the stage-1 cache
+    stage1_cache = None
+    if data.train_stage == 'model2':
+        stage1_cache = load_stage1(data, model)
+
     ## model 1 optimizer
     lr_detail1 = [{"params": filter(lambda p: p.requires_grad, model.mcmodel.parameters()), "lr": data.HP_lr},
                   ]
-    if data.optimizer.lower() == "sgd":
+    if data.train_stage == 'model2':
+        optimizer = None
+    elif data.optimizer.lower() == "sgd":
         optimizer = optim.SGD(lr_detail1,
                               momentum=data.HP_momentum, weight_decay=data.HP_l2)
     elif data.optimizer.lower() == "adagrad":
@@ -271,7 +322,7 @@ def train(data):
     for idx in range(data.HP_iteration):
         epoch_start = time.time()
         print("\n ###### Epoch: %s/%s ######" % (idx, data.HP_iteration))  # print (self.train_Ids)
-        if data.optimizer.lower() == "sgd":
+        if optimizer is not None and data.optimizer.lower() == "sgd":
             optimizer = lr_decay(optimizer, idx, data.HP_lr_decay, data.HP_lr)
 
         sample_loss = 0
@@ -289,14 +340,22 @@ def train(data):
 
             if not instance:
                 continue
-            batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask, doc_idx, word_idx = batchify_with_label(
-                instance, data.HP_gpu, True)
-
-            loss, tag_seq = model.neg_log_likelihood_loss(batch_word, batch_features, batch_wordlen, batch_char,
-                                                          batch_charlen, batch_charrecover, batch_label, mask,
-                                                          doc_idx,
-                                                          word_idx,
-                                                          )
+            telemetry.begin_step()
+            with phase('batchify_with_label'):
+                batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask, doc_idx, word_idx = batchify_with_label(
+                    instance, data.HP_gpu, True)
+
+            stage1 = None
+            if stage1_cache is not None:
+                with phase('stage1_cache'):
+                    stage1 = stage1_cache.get(doc_idx, word_idx, mask)
+            with phase('forward'):
+                loss, tag_seq = model.neg_log_likelihood_loss(batch_word, batch_features, batch_wordlen, batch_char,
+                                                              batch_charlen, batch_charrecover, batch_label, mask,
+                                                              doc_idx,
+                                                              word_idx,
+                                                              stage1,
+                                                              )
 
             sample_loss += loss.item()
             total_loss += loss.item()
@@ -307,13 +366,19 @@ def train(data):
                 sys.stdout.flush()
                 sample_loss = 0
 
-            loss.backward()
-            clip_grad_norm_(model.parameters(), data.clip_grad)
+            with phase('backward'):
+                loss.backward()
+            with phase('optimizer.step'):
+                clip_grad_norm_(model.parameters(), data.clip_grad)
 
-            optimizer.step()
-            optimizer2.step()
-            scheduler2.step()
-            model.zero_grad()
+                if optimizer is not None:
+                    optimizer.step()
+                if data.train_stage != 'model1':
+                    optimizer2.step()
+                    scheduler2.step()
+                model.zero_grad()
+            telemetry.end_step(int(mask.sum()), mode='train', epoch=idx, batch=batch_id, docs=len(instance),
+                               loss=loss.item())
 
         epoch_finish = time.time()
         epoch_cost = epoch_finish - epoch_start
@@ -325,10 +390,10 @@ def train(data):
             exit(1)
 
         # dev
-        dev_score, _ = evaluate(data, model, "dev")
+        dev_score, _ = evaluate(data, model, "dev", stage1_cache)
         
         # test
-        test_score, _ = evaluate(data, model, "test")
+        test_score, _ = evaluate(data, model, "test", stage1_cache)
         
         if max_test < test_score:
             max_test_epoch = idx
@@ -348,16 +413,110 @@ def train(data):
 
         gc.collect()
 
-def load_model_decode(data):
+    if data.train_stage == 'model1':
+        dump_stage1_cache(data, model)
+
+
+def decode_online(data, model, doc):
+    '''
+    decode one document sentence by sentence, as in streaming ingestion: every sentence runs stage 1 and enters the
+    memory on arrival, its stage-2 output is emitted `data.online_delay` sentences later, reading the memory of the
+    sentences arrived so far. with `data.online_revise`, all sentences are decoded again once the document is closed.
+    :return: generator of (sentence index, tag_seq, mask, batch_label, batch_wordrecover), in emission order
+    '''
+    arrived = []
+    pending = []
+
+    def stage2(i):
+        batch, stage1 = arrived[i]
+        batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask, doc_idx, word_idx = batch
+        tag_seq = model(batch_word, batch_features, batch_wordlen, batch_char, batch_charlen, batch_charrecover, mask,
+                        doc_idx, word_idx, stage1, online=True)
+        return i, tag_seq, mask, batch_label, batch_wordrecover
+
+    if model.use_memory:
+        model.memory.reset()
+    for sent in doc:
+        batch = batchify_with_label([[sent]], data.HP_gpu, True)
+        batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask, doc_idx, word_idx = batch
+        stage1 = model.online_stage1(batch_word, batch_features, batch_wordlen, batch_char, batch_charlen,
+                                     batch_charrecover, mask, doc_idx, word_idx)
+        arrived.append((batch, stage1))
+        pending.append(len(arrived) - 1)
+        while len(pending) > data.online_delay:
+            yield stage2(pending.pop(0))
+    # the document is closed
+    for i in pending:
+        yield stage2(i)
+    if data.online_revise:
+        for i in range(len(arrived)):
+            yield stage2(i)
+    if model.use_memory:
+        model.memory.reset()
+
+
+def online_results(data, model, doc):
+    '''
+    :return: last output of decode_online for every sentence of `doc`, in document order
+    '''
+    decoded = {}
+    for sent in decode_online(data, model, doc):
+        decoded[sent[0]] = sent[1:]
+    return [decoded[i] for i in range(len(doc))]
+
+
+def dump_stage1_cache(data, model):
+    '''
+    write per-token p and lstm_out of the (best) model1 on train/dev/test to <model_dir>/stage1_cache
+    '''
+    model_name = data.model_dir + "/best_model.ckpt"
+    if data.save_model and os.path.exists(model_name):
+        model.load_state_dict(torch.load(model_name))
+    cache_dir = data.model_dir + "/stage1_cache"
+    print("Write stage-1 outputs to %s" % cache_dir)
+    stage1_cache = Stage1Cache(cache_dir, data.word_mat, 'w', model.mcmodel.hidden2tag.out_features,
+                               data.HP_hidden_dim)
+    model.eval()
+    with torch.no_grad():
+        for instances in [data.train_Ids, data.dev_Ids, data.test_Ids]:
+            for start in range(0, len(instances), data.HP_batch_size):
+                batch_word, batch_features, batch_wordlen, batch_wordrecover, batch_char, batch_charlen, batch_charrecover, batch_label, mask, doc_idx, word_idx = batchify_with_label(
+                    instances[start:start + data.HP_batch_size], data.HP_gpu, True)
+                p, lstm_out, _, _ = model.forward_stage1(batch_word, batch_features, batch_wordlen, batch_char,
+                                                         batch_charlen, batch_charrecover)
+                stage1_cache.put(doc_idx, word_idx, mask, p, lstm_out)
+    stage1_cache.flush()
+
+
+def load_stage1(data, model):
+    '''
+    load model1 parameters from --stage1_dir and freeze them
+    :return: Stage1Cache written by the model1 stage
+    '''
+    print("Load model1 from dir: ", data.stage1_dir)
+    state_dict = torch.load(data.stage1_dir + "/best_model.ckpt")
+    model.load_state_dict(dict((k, v) for k, v in state_dict.items() if k.startswith("mcmodel.")), strict=False)
+    for p in model.mcmodel.parameters():
+        p.requires_grad = False
+    return Stage1Cache(data.stage1_dir + "/stage1_cache", data.word_mat)
+
+
+def load_model(data):
     print("Load Model from dir: ", data.model_dir)
     model = SeqModel(data)
     model_name = data.model_dir + "/best_model.ckpt"
     model.load_state_dict(torch.load(model_name))
+    if data.compile_mode != 'none':
+        model.compile_inference(data.compile_mode)
+    return model
+
 
+def load_model_decode(data):
+    model = load_model(data)
     evaluate(data, model, "raw")
 
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser(description='Tuning with DocL-NER')
     parser.add_argument('--config', help='Configuration File')
 
@@ -383,6 +542,15 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', default=1, help='number of documents in a batch')
     parser.add_argument('--ave_batch_loss', default=True)
     parser.add_argument('--seed', default=333)
+    parser.add_argument('--online_delay', default=-1,
+                        help='>= 0: decode documents sentence by sentence, emitting each sentence this many sentences '
+                             'after its arrival; -1: decode whole documents')
+    parser.add_argument('--online_revise', default=False,
+                        help='in online decoding, decode all sentences again once the document is closed')
+    parser.add_argument('--train_stage', choices=['joint', 'model1', 'model2'], default='joint',
+                        help='joint: train both stages together, model1: train model1 only and dump its outputs to '
+                             '<model_dir>/stage1_cache, model2: train model2 on the cached outputs of --stage1_dir')
+    parser.add_argument('--stage1_dir', default=None, help='model dir of a finished --train_stage model1 run')
 
     # word representation
     parser.add_argument('--use_char', default=True)
@@ -391,6 +559,8 @@ if __name__ == '__main__':
     parser.add_argument('--char_hidden_dim', default=50)
     parser.add_argument('--word_emb_dim', default=100)
     parser.add_argument('--dropout', default=0.5, help='dropout after representation layer')
+    parser.add_argument('--share_wordrep', default=False, help='share one word representation (word embedding and '
+                                                               'char features) between model1 and model2')
 
     # model1 parameter
     parser.add_argument('--bayesian_lstm_dropout', default=0.01, help='dropout in & between lstm layers')
@@ -401,6 +571,15 @@ if __name__ == '__main__':
     parser.add_argument('--nsample', default=32, help='sample times in testing period, we use 1 for training period')
     parser.add_argument('--threshold', default=0.15, help='the threshold to combine results of two stages, '
                                                           'a smaller one prefers results from the second stage.')
+    parser.add_argument('--uncertainty_mode', choices=['mc', 'moment'], default='mc',
+                        help='mc: nsample MC dropout passes in testing period, '
+                             'moment: one deterministic pass with analytic dropout moment propagation')
+    parser.add_argument('--mc_adaptive', default=False, help='draw MC samples in rounds and stop once the mean '
+                                                             'probabilities and uncertainty converge, nsample is the maximum')
+    parser.add_argument('--mc_round', default=4, help='samples drawn per round in adaptive MC sampling')
+    parser.add_argument('--mc_tol', default=0.01, help='convergence tolerance of adaptive MC sampling')
+    parser.add_argument('--mc_chunk', default=0, help='MC samples replicated through the lstm at a time, '
+                                                      'bounds peak memory on long documents, 0 means all at once')
 
     # model2 parameter
     parser.add_argument('--label_embed_dim', default=400)
@@ -409,10 +588,37 @@ if __name__ == '__main__':
     parser.add_argument('--d_head', default=120)
     parser.add_argument('--n_head', default=7)
     parser.add_argument('--model2_dropout', default=0.2)
+    parser.add_argument('--varlen_encoder', default=False,
+                        help='run the model2 encoder on buckets of sentences of similar length instead of padding '
+                             'all sentences to the longest one')
+    parser.add_argument('--early_exit', default=False,
+                        help='train a label head after every model2 encoder layer but the last, jointly with model2')
+    parser.add_argument('--early_exit_threshold', default=0,
+                        help='> 0 with --early_exit: in testing period a sentence leaves the model2 encoder after the '
+                             'first layer whose head labels every token with at least this probability, 0 runs all '
+                             'layers')
+    parser.add_argument('--checkpoint_activations', default=False,
+                        help='keep only the inputs of every model1 lstm layer and model2 encoder layer in training and '
+                             'recompute their activations in the backward pass, trading time for memory')
     parser.add_argument('--attention_dropout', default=0.15)
+    parser.add_argument('--attn_type', choices=['xl', 'naive'], default='xl',
+                        help='model2 self attention: xl is the relative-position attention, naive plain multi-head '
+                             'attention over sinusoidal absolute positions')
+    parser.add_argument('--attn_impl', choices=['auto', 'sdpa', 'math'], default='auto',
+                        help='kernel of the --attn_type naive model2 attention and of the memory read, the xl attention '
+                             'always runs its own kernels: sdpa runs the fused scaled_dot_product_attention when torch '
+                             'provides it, math the matmul + softmax reference, auto sdpa except for the single-query '
+                             'memory read (so with --attn_type xl, auto is the math kernel everywhere)')
     parser.add_argument('--use_memory', default=True)
     parser.add_argument('--max_read_memory', default=10)
+    parser.add_argument('--memory_topk', default=0,
+                        help='> 0: each token reads only the memory_topk of its max_read_memory neighbours that are '
+                             'the most similar to it, 0 reads all of them')
     parser.add_argument('--memory_attn_nhead', default=1)
+    parser.add_argument('--corpus_memory_size', default=0,
+                        help='number of word types kept in the cross-document memory, 0 disables it')
+    parser.add_argument('--corpus_memory_evict', choices=['lru', 'lfu'], default='lru',
+                        help='eviction of the cross-document memory: least recently / least frequently used type')
     parser.add_argument('--use_crf', default=False)
 
     # optimizer
@@ -427,7 +633,22 @@ if __name__ == '__main__':
     parser.add_argument('--warmup_step', default=0.1)
     parser.add_argument('--learning_rate2', default=0.0001)
 
-    args = parser.parse_args()
+    # inference
+    parser.add_argument('--compile', choices=['none', 'script', 'compile'], default='none',
+                        help='compile the inference graph with TorchScript or torch.compile, '
+                             'falls back to eager mode on failure or output mismatch')
+
+    # cpu
+    parser.add_argument('--num_threads', default=0, help='intra-op threads, 0 means the pytorch default')
+    parser.add_argument('--num_interop_threads', default=0, help='inter-op threads, 0 means the pytorch default')
+    parser.add_argument('--cpu_affinity', default=None, help='cores this process is pinned to, e.g. "0-3,8"')
+    parser.add_argument('--telemetry', default=None, help='write per-step phase timings, tokens/s and peak RSS '
+                                                          'to this JSONL file')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
 
     seed_num = int(args.seed)
     print("Seed num:", seed_num)
@@ -443,6 +664,8 @@ if __name__ == '__main__':
     if args.status == 'train':
         print("MODE: train")
         data.read_config(args)
+        set_cpu_threads(data)
+        set_telemetry(data)
 
         import uuid
 
@@ -463,6 +686,8 @@ if __name__ == '__main__':
         print("MODE: decode")
         data.load(args.model_dir + "/data.dset")
         data.read_config(args)
+        set_cpu_threads(data)
+        set_telemetry(data)
         data.show_data_summary()
         data.generate_instance('raw')
 
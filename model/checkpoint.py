@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from torch.utils.checkpoint import checkpoint as torch_checkpoint
+
+
+def checkpoint(function, *args):
+    '''
+    activation checkpointing: run function(*args) keeping only its inputs, the intermediate activations are
+    recomputed in the backward pass (with the same dropout masks)
+    '''
+    return torch_checkpoint(function, *args, use_reentrant=False)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+import torch
+
+
+class CompiledFunction(object):
+    """Wrap an eager function with a TorchScript / torch.compile counterpart.
+
+    The first `check_calls` calls run both versions on the same inputs (and the same RNG state) and compare the
+    outputs. Any compilation error or output mismatch permanently falls back to the eager function.
+    """
+
+    def __init__(self, fn, mode, name, check_calls=3, rtol=1e-4, atol=1e-5):
+        self.fn = fn
+        self.name = name
+        self.check_calls = check_calls
+        self.rtol = rtol
+        self.atol = atol
+        self.compiled = None
+        try:
+            if mode == 'script':
+                self.compiled = torch.jit.script(fn)
+            elif mode == 'compile':
+                if not hasattr(torch, 'compile'):
+                    raise RuntimeError("torch.compile requires pytorch 2.0 or higher")
+                # random ops (the MC dropout) of the compiled graph draw from the eager generators, otherwise they
+                # never match the eager reference run from the same RNG state
+                from torch._inductor import config as inductor_config
+                inductor_config.fallback_random = True
+                self.compiled = torch.compile(fn, dynamic=True)
+            else:
+                raise ValueError("unknown compile mode: %s" % mode)
+        except Exception as e:
+            print("Warning: cannot compile %s (%s), use eager mode." % (name, e))
+
+    def __call__(self, *args):
+        if self.compiled is None:
+            return self.fn(*args)
+        if self.check_calls <= 0:
+            return self.compiled(*args)
+
+        rng_state = get_rng_state()
+        try:
+            out = self.compiled(*args)
+        except Exception as e:
+            print("Warning: compiled %s failed (%s), fall back to eager mode." % (self.name, e))
+            self.compiled = None
+            set_rng_state(rng_state)
+            return self.fn(*args)
+        set_rng_state(rng_state)
+        ref = self.fn(*args)
+        if not outputs_close(out, ref, self.rtol, self.atol):
+            print("Warning: compiled %s does not match eager output, fall back to eager mode." % self.name)
+            self.compiled = None
+        else:
+            self.check_calls -= 1
+        return ref
+
+
+def get_rng_state():
+    '''state of the cpu generator and, once cuda is in use, of every cuda generator'''
+    cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+    return torch.get_rng_state(), torch.cuda.get_rng_state_all() if cuda else None
+
+
+def set_rng_state(state):
+    cpu_state, cuda_state = state
+    torch.set_rng_state(cpu_state)
+    if cuda_state is not None:
+        torch.cuda.set_rng_state_all(cuda_state)
+
+
+def outputs_close(a, b, rtol, atol):
+    if isinstance(a, (tuple, list)):
+        return isinstance(b, (tuple, list)) and len(a) == len(b) and \
+               all(outputs_close(x, y, rtol, atol) for x, y in zip(a, b))
+    if isinstance(a, torch.Tensor):
+        if not isinstance(b, torch.Tensor) or a.size() != b.size() or a.dtype != b.dtype:
+            return False
+        if a.is_floating_point():
+            return torch.allclose(a, b, rtol=rtol, atol=atol)
+        return torch.equal(a, b)
+    return a == b
@@ -3,9 +3,11 @@ from __future__ import print_function
 from __future__ import absolute_import
 import torch.nn as nn
 import torch
+import math
 import torch.nn.functional as F
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import PackedSequence
 from .wordrep import WordRep
+from .checkpoint import checkpoint
 
 
 class MCmodel(nn.Module):
@@ -33,6 +35,10 @@ class MCmodel(nn.Module):
                                           bidirectional=self.bilstm_flag))
 
         self.hidden2tag = nn.Linear(data.HP_hidden_dim, data.label_alphabet_size)
+        self.compiled_rest = None
+        self.checkpoint = data.checkpoint_activations  # activation checkpointing of every lstm layer in training
+        self.mc_chunk = data.HP_mc_chunk
+        self.mc_stats = [0, 0]  # number of MC samples drawn, number of MC_sampling calls
 
         if self.gpu:
             self.lstms = self.lstms.cuda()
@@ -49,24 +55,16 @@ class MCmodel(nn.Module):
                                       char_seq_recover)
         return word_represent
 
-    def forward_rest(self, word_represent, word_seq_lengths):
-        if not self.training:
-            ordered_lens, index = word_seq_lengths.sort(descending=True)
-            ordered_x = word_represent[index]
-        else:
-            ordered_x, ordered_lens = word_represent, word_seq_lengths
+    def forward_rest(self, word_represent, word_seq_lengths, plan=None):
+        if plan is None:
+            plan = PackPlan(word_seq_lengths, word_represent.size(1))
 
+        lstm_out = word_represent
         for i,lstm in enumerate(self.lstms):
-            ordered_x = add_dropout(ordered_x, self.model1_in_dropout)
-            pack_input = pack_padded_sequence(ordered_x, ordered_lens, batch_first=True)
-            pack_output, _ = lstm(pack_input)
-            ordered_x, _ = pad_packed_sequence(pack_output, batch_first=True)
-
-        if not self.training:
-            recover_index = index.argsort()
-            lstm_out = ordered_x[recover_index]
-        else:
-            lstm_out = ordered_x
+            if self.checkpoint and self.training and torch.is_grad_enabled():
+                lstm_out = checkpoint(self.lstm_layer, lstm, plan, lstm_out)
+            else:
+                lstm_out = self.lstm_layer(lstm, plan, lstm_out)
 
         h2t_in = add_dropout(lstm_out, self.model1_fc_dropout)
         outs = self.hidden2tag(h2t_in)
@@ -74,24 +72,147 @@ class MCmodel(nn.Module):
         p = F.softmax(outs, -1)
         return p, lstm_out, outs, word_represent
 
-    def MC_sampling(self, word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
-                    char_seq_recover, mc_steps):
+    def lstm_layer(self, lstm, plan, lstm_out):
+        lstm_out = add_dropout(lstm_out, self.model1_in_dropout)
+        pack_output, _ = lstm(plan.pack(lstm_out))
+        return plan.unpack(pack_output)
 
+    def MC_sampling(self, word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
+                    char_seq_recover, mc_steps, mc_round=None, tol=None):
+        '''
+        average p, lstm_out and outs over `mc_steps` dropout samples.
+        with `tol`, samples are drawn `mc_round` at a time and sampling stops early once the mean probabilities and
+        their entropy change by less than `tol` between two rounds.
+        '''
         word_represent = self.forward_word(word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
                                            char_seq_recover)
         batch, max_seq_len = word_represent.size()[:2]
+        if tol is None or mc_round is None:
+            mc_round = mc_steps
+        mask = torch.arange(max_seq_len, device=word_seq_lengths.device)[None, :] < word_seq_lengths[:, None]
+        plan = PackPlan(word_seq_lengths, max_seq_len)
+
+        sums = None
+        last_p, last_entropy = None, None
+        nsample = 0
+        while nsample < mc_steps:
+            steps = min(mc_round, mc_steps - nsample)
+            outputs = self.sample_sum(word_represent, plan, steps, self.mc_chunk)
+            sums = outputs if sums is None else [s + o for s, o in zip(sums, outputs)]
+            nsample += steps
+
+            if tol is not None and nsample < mc_steps:
+                p = sums[0] / nsample
+                entropy = -((p + 1e-30) * (p + 1e-30).log()).sum(-1).masked_fill(~mask, 0)
+                if last_p is not None and ((p - last_p).abs().max().item() < tol and
+                                           (entropy - last_entropy).abs().max().item() < tol):
+                    break
+                last_p, last_entropy = p, entropy
+
+        self.mc_stats[0] += nsample
+        self.mc_stats[1] += 1
+        p, lstm_out, outs = [s / nsample for s in sums]
+        return p, lstm_out, outs, word_represent
 
-        word_represent = word_represent.repeat([mc_steps] + [1 for _ in range(1, len(word_represent.size()))])
-        word_seq_lengths = word_seq_lengths.repeat([mc_steps] + [1 for _ in range(1, len(word_seq_lengths.size()))])
-
-        p, lstm_out, outs, word_represent = self.forward_rest(word_represent, word_seq_lengths)
-
-        p = p.reshape(mc_steps, batch, max_seq_len, -1).mean(0)
-        lstm_out = lstm_out.reshape(mc_steps, batch, max_seq_len, -1).mean(0)
-        outs = outs.reshape(mc_steps, batch, max_seq_len, -1).mean(0)
-        word_represent = word_represent.reshape(mc_steps, batch, max_seq_len, -1).mean(0)
+    def moment_propagation(self, word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
+                           char_seq_recover):
+        '''
+        deterministic single-pass alternative to MC_sampling.
+        the lstm stack runs at the mean of its input dropout, the dropout before hidden2tag is propagated analytically:
+        the logits are treated as a gaussian with variance sum_j W_cj^2 * h_j^2 * q / (1 - q), and p is the probit
+        approximation of its expected softmax, softmax(mean / sqrt(1 + pi * var / 8)).
+        '''
+        word_represent = self.forward_word(word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
+                                           char_seq_recover)
+        plan = PackPlan(word_seq_lengths, word_represent.size(1))
+        lstm_out = word_represent
+        for lstm in self.lstms:
+            pack_output, _ = lstm(plan.pack(lstm_out))
+            lstm_out = plan.unpack(pack_output)
+
+        outs = self.hidden2tag(lstm_out)
+        q = self.model1_fc_dropout
+        var = torch.matmul(lstm_out ** 2, (self.hidden2tag.weight ** 2).t()) * (q / (1 - q))
+        p = F.softmax(outs / torch.sqrt(1 + math.pi / 8 * var), -1)
         return p, lstm_out, outs, word_represent
 
+    def sample_sum(self, word_represent, plan, mc_steps, chunk=0):
+        '''
+        sum of p, lstm_out and outs over `mc_steps` dropout samples.
+        samples are replicated through the lstm `chunk` at a time (all at once if chunk <= 0), so peak memory depends
+        on `chunk` instead of `mc_steps`.
+        :param plan: PackPlan of the un-replicated batch
+        '''
+        batch, max_seq_len = word_represent.size()[:2]
+        if chunk <= 0:
+            chunk = mc_steps
+        forward_rest = self.compiled_rest if self.compiled_rest is not None else self.forward_rest
+
+        sums = None
+        for begin in range(0, mc_steps, chunk):
+            steps = min(chunk, mc_steps - begin)
+            chunk_represent = word_represent.repeat([steps] + [1 for _ in range(1, len(word_represent.size()))])
+
+            p, lstm_out, outs, _ = forward_rest(chunk_represent, None, plan.replicate(steps))
+
+            outputs = [x.reshape(steps, batch, max_seq_len, -1).sum(0) for x in (p, lstm_out, outs)]
+            sums = outputs if sums is None else [s + o for s, o in zip(sums, outputs)]
+        return sums
+
+
+class PackPlan(object):
+    '''
+    Packing metadata of a padded batch, computed once and reused by every lstm layer (and every MC sample through
+    `replicate`). Sequences do not need to be sorted: packed rows are gathered from / scattered to their original
+    positions directly, so the batch itself is never permuted.
+    '''
+
+    def __init__(self, lengths=None, max_len=None):
+        if lengths is None:
+            return
+        device = lengths.device
+        lengths = lengths.cpu()
+        sorted_lens, order = lengths.sort(descending=True)
+        self.batch = lengths.size(0)
+        self.max_len = max_len
+        self.order = order
+        # batch_sizes[t]: number of sequences longer than t
+        self.batch_sizes = (sorted_lens[None, :] > torch.arange(max_len)[:, None]).long().sum(1)
+        self.batch_sizes = self.batch_sizes[self.batch_sizes > 0]
+        self.index = self.build_index(order, self.batch_sizes, max_len).to(device)
+        self.replicas = {1: self}
+
+    @staticmethod
+    def build_index(order, batch_sizes, max_len):
+        '''positions in the flattened (batch * max_len) tensor of the time-major packed rows'''
+        steps, batch = batch_sizes.size(0), order.size(0)
+        time = torch.arange(steps)[:, None].expand(steps, batch)
+        valid = torch.arange(batch)[None, :] < batch_sizes[:, None]
+        return (order[None, :] * max_len + time)[valid]
+
+    def replicate(self, n):
+        '''plan of the batch repeated n times along the batch dimension (as `Tensor.repeat`), without re-sorting'''
+        if n not in self.replicas:
+            plan = PackPlan()
+            plan.batch = self.batch * n
+            plan.max_len = self.max_len
+            # copy s of sequence order[r] is row s * batch + order[r], copies of one sequence stay adjacent
+            plan.order = (torch.arange(n)[None, :] * self.batch + self.order[:, None]).reshape(-1)
+            plan.batch_sizes = self.batch_sizes * n
+            plan.index = self.build_index(plan.order, plan.batch_sizes, self.max_len).to(self.index.device)
+            plan.replicas = {}
+            self.replicas[n] = plan
+        return self.replicas[n]
+
+    def pack(self, x):
+        ''' x: batch * max_len * hidden '''
+        return PackedSequence(x.reshape(-1, x.size(-1)).index_select(0, self.index), self.batch_sizes)
+
+    def unpack(self, packed):
+        data = packed.data
+        out = data.new_zeros(self.batch * self.max_len, data.size(-1)).index_copy(0, self.index, data)
+        return out.view(self.batch, self.max_len, -1)
+
 
 def add_dropout(x, dropout):
     ''' x: batch * seq_len * hidden '''
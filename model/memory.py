@@ -4,7 +4,9 @@ from __future__ import absolute_import
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import numpy as np
 import math
+from .transformer import use_sdpa
 
 class Memory(nn.Module):
     def __init__(self, data):
@@ -17,37 +19,312 @@ class Memory(nn.Module):
         self.attn = MultiHeadAttn(data.d_model, data.d_model, self.h_dim, self.l_dim, data.HP_memory_attn_nhead)
         self.mem_h = None
         self.mem_l = None
+        self.mem_k = None  # mem_h / mem_l projected by the key / value projections of attn
+        self.mem_v = None
+        self.mem_docs = None  # sorted documents of the last put
+        self.mem_start = None  # first memory row of each of them
+        # mem_h / mem_l are views of these buffers, which grow geometrically and are reused across batches
+        self.reuse_buffers = True
+        self.buf_h = None
+        self.buf_l = None
+        self.buffer_stats = [0, 0]  # number of buffer allocations, number of puts
 
         self.max_read_memory = data.HP_max_read_memory
+        self.topk = data.HP_memory_topk  # > 0: only read the topk neighbours most similar to the token
+        self.build_index()
+
+        # optional cross-document memory, one extra key per token read from previous batches
+        self.corpus = None
+        if data.HP_corpus_memory_size > 0:
+            self.corpus = CorpusMemory(data.word_alphabet, data.HP_corpus_memory_size, self.h_dim, self.l_dim,
+                                       data.HP_corpus_memory_evict)
+        self.mem_corpus_h = None  # corpus entry of every memory row, looked up at put
+        self.mem_corpus_l = None
+        self.mem_corpus_found = None
+        # rows written so far in online decoding (see append), None when the whole batch was put at once
+        self.mem_filled = None
+
+    def build_index(self):
+        '''
+        convert word_mat into CSR form: the neighbours of word w of document d are
+        neighbours[offsets[doc_start[d] + w]: offsets[doc_start[d] + w + 1]].
+        the tensors are plain attributes (not buffers), so checkpoints do not depend on the documents loaded.
+        '''
+        counts = [(m != 0).sum(-1) for m in self.word_mat]
+        doc_rows = np.array([m.shape[0] for m in self.word_mat], dtype=np.int64)
+        self.index_docs = len(self.word_mat)
+        self.doc_rows = torch.from_numpy(doc_rows)
+        self.doc_start = torch.from_numpy(np.concatenate([[0], np.cumsum(doc_rows)[:-1]]).astype(np.int64))
+        self.nbr_offsets = torch.from_numpy(np.concatenate([[0]] + counts).cumsum().astype(np.int64))
+        # trailing 0 so that gathers past the last neighbour stay in range
+        self.neighbours = torch.from_numpy(np.concatenate([m[m != 0] for m in self.word_mat] + [[0]]).astype(np.int64))
+
+    def index_to(self, device):
+        if self.index_docs != len(self.word_mat):  # documents were added after the index was built
+            self.build_index()
+        if self.neighbours.device != device:
+            self.doc_start = self.doc_start.to(device)
+            self.doc_rows = self.doc_rows.to(device)
+            self.nbr_offsets = self.nbr_offsets.to(device)
+            self.neighbours = self.neighbours.to(device)
+
+    def neighbour_idx(self, doc_idx, word_idx):
+        '''
+        :return: (batch_size * max_seq_len, max number of neighbours) word indices of the neighbours of every token,
+            0 for padding
+        '''
+        self.index_to(word_idx.device)
+        rows = (self.doc_start[doc_idx][:, None] + word_idx).reshape(-1)
+        start = self.nbr_offsets[rows]
+        count = self.nbr_offsets[rows + 1] - start
+        max_count = count.max().item()
+        pos = torch.arange(max_count, device=word_idx.device)
+        valid = pos[None, :] < count[:, None]
+        idx = self.neighbours[(start[:, None] + pos[None, :]).clamp(max=self.neighbours.size(0) - 1)]
+        return idx.masked_fill(~valid, 0)
 
     def get(self, query_h, doc_idx, word_idx):
         batch_size, max_seq_len, hidden_dim = query_h.size()
         num = batch_size * max_seq_len
-        idx = word_idx.new_tensor(self.word_mat[doc_idx[0]][word_idx.reshape(-1).cpu()]) # num * max_memory_size
-        max_word_idx_len = (idx != 0).sum(-1).max().item()
-        if max_word_idx_len==0:
+        idx = self.neighbour_idx(doc_idx, word_idx) # num * max_word_idx_len
+        max_word_idx_len = idx.size(-1)
+        if max_word_idx_len==0 and self.corpus is None:
             return self.default_h[None,None,...].expand_as(query_h), self.default_l[None,None,...].expand_as(query_h)
 
-        idx = idx[...,:max_word_idx_len]
         mask = idx != 0
-        h, l = self.attn(query_h.reshape((-1, 1, hidden_dim)),
-                         self.mem_h[idx],
-                         self.mem_l[idx],
-                         mask.reshape((num, 1, max_word_idx_len))) # num, 1, d_model
-        len_mask = mask.sum(-1) == 0
-        h[len_mask] = self.default_h
-        l[len_mask] = self.default_l
+        rows = (self.slots(doc_idx, word_idx) + word_idx).reshape(-1)  # memory row of every token
+        idx = idx + (rows - word_idx.reshape(-1))[:, None]  # word index -> memory row of its document
+        if self.mem_filled is not None:  # neighbours in sentences that have not arrived yet are not read
+            mask = mask & self.mem_filled[idx]
+        if 0 < self.topk < max_word_idx_len:
+            idx, mask = self.select_topk(rows, idx, mask)
+            max_word_idx_len = self.topk
+        mem_k, mem_v = self.mem_k[idx], self.mem_v[idx]
+        if self.corpus is not None:
+            # the entry of the word type in the corpus memory is read alongside the in-document neighbours
+            mem_k = torch.cat([mem_k, self.attn.k_linear(self.mem_corpus_h[rows])[:, None]], 1)
+            mem_v = torch.cat([mem_v, self.attn.v_linear(self.mem_corpus_l[rows])[:, None]], 1)
+            mask = torch.cat([mask, self.mem_corpus_found[rows][:, None]], 1)
+            max_word_idx_len += 1
+        h, l = self.attn.attend(query_h.reshape((-1, 1, hidden_dim)),
+                                mem_k,
+                                mem_v,
+                                mask.reshape((num, 1, max_word_idx_len))) # num, 1, d_model
+        len_mask = (mask.sum(-1) == 0)[:, None, None]  # tokens without any neighbour read the default entry
+        h = torch.where(len_mask, self.default_h, h)
+        l = torch.where(len_mask, self.default_l, l)
 
         h = h.reshape(batch_size, max_seq_len, hidden_dim)
         l = l.reshape(batch_size, max_seq_len, hidden_dim)
         return h, l
 
-    def put(self, h, l, word_idx):
-        max_idx = word_idx.max().item()
-        self.mem_h = h.new_zeros(max_idx + 1, self.h_dim)
-        self.mem_l = l.new_zeros(max_idx + 1, self.l_dim)
-        self.mem_h.data[word_idx] = h.data
-        self.mem_l.data[word_idx] = l.data
+    def select_topk(self, rows, idx, mask):
+        '''
+        keep the topk neighbours whose mem_h is the most cosine-similar to the mem_h of the token itself
+        :param rows: (num, ) memory row of every token
+        :param idx: (num, max_word_idx_len) memory rows of the neighbours
+        :param mask: (num, max_word_idx_len)
+        :return: idx, mask of the selected neighbours, (num, topk)
+        '''
+        mem = F.normalize(self.mem_h, dim=-1)
+        sim = torch.bmm(mem[idx], mem[rows][:, :, None]).squeeze(-1)  # num, max_word_idx_len
+        sim = sim.masked_fill(~mask, float('-inf'))
+        top = sim.topk(self.topk, dim=-1)[1]
+        return idx.gather(1, top), mask.gather(1, top)
+
+    def slots(self, doc_idx, word_idx):
+        '''
+        :return: (batch_size, max_seq_len) first memory row of the document of every token, for the last put
+        '''
+        start = self.mem_start[torch.searchsorted(self.mem_docs, doc_idx)]
+        return start[:, None].expand_as(word_idx)
+
+    def put(self, h, l, doc_idx, word_idx, word_inputs=None):
+        '''
+        the memory is keyed by (doc, word): every document of the batch gets its own block of rows, so a batch can
+        hold sentences of several documents.
+        :param doc_idx: (batch_size, )
+        :param word_idx: (batch_size, max_seq_len), restarts at 1 in every document
+        :param word_inputs: (batch_size, max_seq_len), word ids, required by the corpus memory
+        '''
+        self.allocate(h, l, doc_idx)
+        self.mem_filled = None
+        self.write(h, l, doc_idx, word_idx, word_inputs)
+        self.project()
+
+    def append(self, h, l, doc_idx, word_idx, word_inputs=None):
+        '''
+        online decoding: add the sentences of `doc_idx` to the memory of their document(s), which is started when the
+        documents change. get() only reads neighbours of the sentences appended so far.
+        '''
+        self.index_to(word_idx.device)
+        docs = torch.unique(doc_idx)
+        if self.mem_filled is None or not torch.equal(docs, self.mem_docs):
+            self.allocate(h, l, doc_idx)
+            self.mem_filled = word_idx.new_zeros(self.mem_h.size(0), dtype=torch.bool)
+            self.project()
+        self.write(h, l, doc_idx, word_idx, word_inputs)
+        idx = self.slots(doc_idx, word_idx) + word_idx
+        self.mem_filled[idx] = word_idx > 0
+        self.mem_k[idx] = self.attn.k_linear(h)
+        self.mem_v[idx] = self.attn.v_linear(l)
+
+    def project(self):
+        '''
+        project every memory row once with the key / value projections of the memory attention, get() only gathers
+        the projected rows of the neighbours
+        '''
+        self.mem_k = self.attn.k_linear(self.mem_h)
+        self.mem_v = self.attn.v_linear(self.mem_l)
+
+    def reset(self):
+        '''end online decoding of the current document(s)'''
+        self.mem_filled = None
+        self.mem_docs = None
+
+    def allocate(self, h, l, doc_idx):
+        '''
+        clear the memory and give every document of `doc_idx` its block of rows
+        '''
+        self.index_to(doc_idx.device)
+        self.mem_docs = torch.unique(doc_idx)
+        sizes = self.doc_rows[self.mem_docs]
+        self.mem_start = sizes.cumsum(0) - sizes
+        num = int(sizes.sum())
+        self.buf_h = self.reserve(self.buf_h, h, num)
+        self.buf_l = self.reserve(self.buf_l, l, num)
+        self.buffer_stats[1] += 1
+        # only the used prefix is cleared
+        self.mem_h = self.buf_h[:num].zero_()
+        self.mem_l = self.buf_l[:num].zero_()
+        if self.corpus is not None:
+            self.mem_corpus_h = h.new_zeros(num, self.h_dim)
+            self.mem_corpus_l = l.new_zeros(num, self.l_dim)
+            self.mem_corpus_found = doc_idx.new_zeros(num, dtype=torch.bool)
+
+    def write(self, h, l, doc_idx, word_idx, word_inputs):
+        idx = self.slots(doc_idx, word_idx) + word_idx
+        self.mem_h.data[idx] = h.data
+        self.mem_l.data[idx] = l.data
+
+        if self.corpus is not None:
+            # read the corpus memory before these sentences are added to it
+            types = self.corpus.types(word_inputs).masked_fill(word_idx == 0, 0)
+            corpus_h, corpus_l, found = self.corpus.lookup(types)
+            self.mem_corpus_h[idx] = corpus_h.to(h)
+            self.mem_corpus_l[idx] = corpus_l.to(l)
+            self.mem_corpus_found[idx] = found
+            self.corpus.update(types, h.detach(), l.detach())
+
+    def update_corpus(self, h, l, word_idx, word_inputs):
+        '''
+        add sentences that are not put into the memory (stage 2 is skipped for them) to the corpus memory
+        '''
+        types = self.corpus.types(word_inputs).masked_fill(word_idx == 0, 0)
+        self.corpus.update(types, h.detach(), l.detach())
+
+    def reserve(self, buf, x, num):
+        '''
+        :return: `buf` if it holds at least `num` rows of the dtype / device of `x`, else a new buffer
+        '''
+        if (self.reuse_buffers and buf is not None and buf.size(0) >= num and buf.dtype == x.dtype
+                and buf.device == x.device):
+            return buf
+        self.buffer_stats[0] += 1
+        if self.reuse_buffers and buf is not None and buf.dtype == x.dtype and buf.device == x.device:
+            num = max(num, 2 * buf.size(0))
+        return x.new_empty(num, x.size(-1))
+
+
+class CorpusMemory(object):
+    '''
+    Fixed-size store of the latest (h, l) summary of each word type (lowercased word), shared by all documents.
+    When the store is full, the least recently used ('lru') or least frequently used ('lfu') types are evicted.
+    Words outside the word alphabet have no type and are neither stored nor read.
+    '''
+
+    def __init__(self, word_alphabet, size, h_dim, l_dim, evict='lru'):
+        lower2type = {}
+        word2type = [0] * word_alphabet.size()
+        for word, index in word_alphabet.iteritems():
+            if word != word_alphabet.UNKNOWN:
+                word2type[index] = lower2type.setdefault(word.lower(), len(lower2type) + 1)
+        self.word2type = torch.tensor(word2type, dtype=torch.long)
+        self.type2slot = torch.full((len(lower2type) + 1,), -1, dtype=torch.long)
+        self.slot_type = torch.full((size,), -1, dtype=torch.long)
+        self.store_h = torch.zeros(size, h_dim)
+        self.store_l = torch.zeros(size, l_dim)
+        self.last_used = torch.zeros(size, dtype=torch.long)
+        self.count = torch.zeros(size, dtype=torch.long)
+        self.size = size
+        self.evict = evict
+        self.step = 0
+
+    def to(self, device):
+        if self.word2type.device != device:
+            for name in ['word2type', 'type2slot', 'slot_type', 'store_h', 'store_l', 'last_used', 'count']:
+                setattr(self, name, getattr(self, name).to(device))
+
+    def types(self, word_inputs):
+        '''
+        :return: word type of every token, 0 for none
+        '''
+        self.to(word_inputs.device)
+        return self.word2type[word_inputs]
+
+    def lookup(self, types):
+        '''
+        :return: stored h, l of every token and whether its type is in the store
+        '''
+        slot = self.type2slot[types]
+        found = (slot >= 0) & (types > 0)
+        slot = slot.clamp(min=0)
+        return self.store_h[slot], self.store_l[slot], found
+
+    def update(self, types, h, l):
+        '''
+        replace the entries of the types of the batch by the mean of their mentions, inserting new types into empty
+        or evicted slots.
+        :param types: (batch_size, max_seq_len), 0 for tokens that are not stored
+        '''
+        valid = types > 0
+        types = types[valid]
+        if types.numel() == 0:
+            return
+        uniq, inverse = torch.unique(types, return_inverse=True)
+        counts = torch.zeros(uniq.size(0), dtype=torch.long, device=types.device).index_add_(
+            0, inverse, torch.ones_like(inverse))
+        mean_h = h.new_zeros(uniq.size(0), h.size(-1)).index_add_(0, inverse, h[valid]) / counts[:, None].to(h)
+        mean_l = l.new_zeros(uniq.size(0), l.size(-1)).index_add_(0, inverse, l[valid]) / counts[:, None].to(l)
+        self.store_h = self.store_h.to(h)
+        self.store_l = self.store_l.to(l)
+
+        slots = self.type2slot[uniq]
+        new = (slots < 0).nonzero().squeeze(-1)
+        # at most size types per batch, the types already stored keep their slots
+        new = new[:self.size - (uniq.size(0) - new.size(0))]
+        if new.size(0) > 0:
+            if self.evict == 'lfu':
+                score = self.count * (self.step + 1) + self.last_used
+            else:
+                score = self.last_used.clone()
+            score[self.slot_type < 0] = -1  # empty slots first
+            score[slots[slots >= 0]] = torch.iinfo(score.dtype).max
+            victims = torch.topk(score, new.size(0), largest=False)[1]
+            evicted = self.slot_type[victims]
+            self.type2slot[evicted[evicted >= 0]] = -1
+            self.slot_type[victims] = uniq[new]
+            self.type2slot[uniq[new]] = victims
+            self.count[victims] = 0
+            slots[new] = victims
+
+        keep = slots >= 0
+        slots = slots[keep]
+        self.store_h[slots] = mean_h[keep]
+        self.store_l[slots] = mean_l[keep]
+        self.count[slots] += counts[keep]
+        self.last_used[slots] = self.step
+        self.step += 1
 
 
 class MultiHeadAttn(nn.Module):
@@ -59,16 +336,22 @@ class MultiHeadAttn(nn.Module):
         self.v_linear = nn.Linear(v_dim, d_model)
         self.dropout_layer = nn.Dropout(dropout)
         self.scale = math.sqrt(d_model // n_head)
-
+        self.attn_impl = 'auto'
 
     def forward(self, q, k, v, mask=None):
+        return self.attend(q, self.k_linear(k), self.v_linear(v), mask)
+
+    def attend(self, q, k, v, mask=None):
+        '''
+        attention over keys / values already projected by k_linear / v_linear
+        '''
         batch_size, q_len, d_model = q.size()
         batch_size, k_len, d_model = k.size()
         q = self.q_linear(q)
-        k = self.k_linear(k)
-        v = self.v_linear(v)
 
         q = q.view(batch_size, q_len, self.n_head, -1).transpose(1, 2)
+        if use_sdpa(self.attn_impl, q_len):
+            return self.attend_sdpa(q, k, v, mask)
         k = k.view(batch_size, k_len, self.n_head, -1).permute(0, 2, 3, 1)
         v = v.view(batch_size, k_len, self.n_head, -1).transpose(1, 2)
 
@@ -86,4 +369,23 @@ class MultiHeadAttn(nn.Module):
 
         k = torch.matmul(attn, k.transpose(2, 3))
         k = k.transpose(1, 2).reshape(batch_size, q_len, -1)
-        return k, v
\ No newline at end of file
+        return k, v
+
+    def attend_sdpa(self, q, k, v, mask=None):
+        '''
+        attend with F.scaled_dot_product_attention, the attended keys and values come out of one call by using
+        [k; v] as the values. rows without any key attend to all keys instead of producing nan, Memory.get replaces
+        their output with the default entry.
+        :param q: batch_size x n_head x q_len x head_dim
+        '''
+        batch_size, n_head, q_len, head_dim = q.size()
+        k_len = k.size(1)
+        k = k.view(batch_size, k_len, n_head, -1).transpose(1, 2)
+        kv = torch.cat([k, v.view(batch_size, k_len, n_head, -1).transpose(1, 2)], -1)
+        if mask is not None:
+            mask = mask[:, None].bool()
+            mask = mask | ~mask.any(-1, keepdim=True)
+        out = F.scaled_dot_product_attention(q, k, kv, attn_mask=mask,
+                                             dropout_p=self.dropout_layer.p if self.training else 0.)
+        k, v = out.transpose(1, 2).chunk(2, -1)  # batch_size x q_len x n_head x head_dim
+        return k.reshape(batch_size, q_len, -1), v.reshape(batch_size, q_len, -1)
\ No newline at end of file
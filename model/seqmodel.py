@@ -7,9 +7,11 @@ import torch.nn.functional as F
 from .mc_model import MCmodel
 from .crf import CRF
 from .wordrep import WordRep
-from .transformer import TransformerEncoder
+from .transformer import TransformerEncoder, use_sdpa
 import numpy as np
 from .memory import Memory
+from .compiled import CompiledFunction
+from utils.telemetry import phase
 
 class SeqModel(nn.Module):
     def __init__(self, data):
@@ -26,7 +28,12 @@ class SeqModel(nn.Module):
 
         self.mcmodel = MCmodel(data)
 
-        self.wordrep = WordRep(data)
+        # with shared word representation, model2 reuses the word embedding and char features of model1
+        self.share_wordrep = data.share_wordrep
+        if self.share_wordrep:
+            self.wordrep = self.mcmodel.wordrep
+        else:
+            self.wordrep = WordRep(data)
         self.label_embedding = nn.Embedding(data.label_alphabet_size, data.HP_label_embed_dim)
         self.label_embedding.weight.data.copy_(torch.from_numpy(
             random_embedding_label(data.label_alphabet_size, data.HP_label_embed_dim, data.label_embedding_scale)))
@@ -36,12 +43,23 @@ class SeqModel(nn.Module):
 
         self.encoder = TransformerEncoder(data.HP_model2_layer, data.d_model, data.HP_nhead,
                                           data.HP_dim_feedforward,dropout=data.HP_model2_dropout, dropout_attn=data.HP_attention_dropout,
+                                          attn_type=data.attn_type,
+                                          pos_embed='sin' if data.attn_type == 'naive' else None,
                                           )
 
         self.model2_fc_dropout = nn.Dropout(data.HP_model2_dropout)
 
         self.hidden2tag = nn.Linear(data.d_model * 2, data.label_alphabet_size)
-        self.m2_params = [self.wordrep, self.word2hidden, self.label2hidden, self.encoder, self.hidden2tag, self.label_embedding]
+        self.m2_params = [self.word2hidden, self.label2hidden, self.encoder, self.hidden2tag, self.label_embedding]
+        # label heads after every encoder layer but the last, trained jointly, used for early exit in testing period
+        self.exit_heads = None
+        if data.early_exit:
+            self.exit_heads = nn.ModuleList([nn.Linear(data.d_model * 2, data.label_alphabet_size)
+                                             for _ in range(data.HP_model2_layer - 1)])
+            self.m2_params.append(self.exit_heads)
+        self.early_exit_threshold = data.early_exit_threshold
+        if not self.share_wordrep:  # a shared wordrep is optimized with model1
+            self.m2_params.append(self.wordrep)
 
         self.use_memory = data.use_memory
         if self.use_memory:
@@ -52,7 +70,25 @@ class SeqModel(nn.Module):
             self.m2_params.append(self.crf)
 
         self.nsamples = data.HP_nsamples
+        self.mc_round = data.HP_mc_round
+        self.mc_tol = data.HP_mc_tol if data.HP_mc_adaptive else None
+        self.uncertainty_mode = data.HP_uncertainty_mode
         self.threshold = data.HP_threshold
+        self.train_stage = data.train_stage  # joint / model1 / model2
+        self.varlen_encoder = data.varlen_encoder
+        self.encoder.varlen = data.varlen_encoder
+        self.encoder.checkpoint = data.checkpoint_activations
+        if data.attn_impl == 'sdpa' and not use_sdpa('sdpa'):
+            print("Warning: this torch has no scaled_dot_product_attention, attention runs the math kernel")
+        self.encoder.set_attn_impl(data.attn_impl)
+        if self.use_memory:
+            self.memory.attn.attn_impl = data.attn_impl
+        self.compiled = None
+        self.skip_stage2 = True  # in testing period, model2 only runs on sentences with uncertain tokens
+        # number of batches running model2, number of batches, number of sentences running model2, number of sentences
+        self.stage2_stats = [0, 0, 0, 0]
+        # encoder layers run by the sentences of model2, number of these sentences
+        self.exit_stats = [0, 0]
 
         if self.gpu:
             self.label_embedding = self.label_embedding.cuda()
@@ -60,11 +96,13 @@ class SeqModel(nn.Module):
             self.label2hidden = self.label2hidden.cuda()
             self.encoder = self.encoder.cuda()
             self.hidden2tag = self.hidden2tag.cuda()
+            if self.exit_heads is not None:
+                self.exit_heads = self.exit_heads.cuda()
             if self.use_memory:
                 self.memory = self.memory.cuda()
 
     def neg_log_likelihood_loss(self, word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
-                                char_seq_recover, batch_label, mask, doc_idx,  word_idx):
+                                char_seq_recover, batch_label, mask, doc_idx,  word_idx, stage1=None):
         '''
 
         :param word_inputs: (batch_size, max_seq_len)
@@ -77,6 +115,7 @@ class SeqModel(nn.Module):
         :param mask: (batch_size, max_seq_len)
         :param doc_idx: (batch_size, )
         :param word_idx: (batch_size, max_seq_len)
+        :param stage1: cached (p, lstm_out) of a frozen model1, model1 is not run when given
         :return:
             loss: scalar
             predicted_seq: (batch_size, max_seq_len)
@@ -86,11 +125,18 @@ class SeqModel(nn.Module):
         mask = mask.eq(1)
 
         # stage 1: forward model1 to generate draft labels and uncertainty
-        p, lstm_out, outs1, _ = self.mcmodel(word_inputs, feature_inputs, word_seq_lengths, char_inputs,
-                                             char_seq_lengths,
-                                             char_seq_recover)
+        if stage1 is not None:
+            (p, lstm_out), outs1, word_represent = stage1, stage1[0], None
+        else:
+            with phase('mcmodel'):
+                p, lstm_out, outs1, word_represent = self.mcmodel(word_inputs, feature_inputs, word_seq_lengths, char_inputs,
+                                                                  char_seq_lengths,
+                                                                  char_seq_recover)
 
         model1_preds = self.decode_seq(outs1, mask, m1=True)
+        if self.train_stage == 'model1':
+            loss = self.get_loss(outs1, mask, batch_label, m1=True)
+            return loss / batch_size if self.average_batch else loss, model1_preds
 
         uncertainty = epistemic_uncertainty(p, mask)
         label_mask = generate_label_mask(uncertainty, mask, threshold=self.threshold)
@@ -99,66 +145,181 @@ class SeqModel(nn.Module):
         model2_input_label_embed = torch.einsum("bsc,cd->bsd", [p.detach(), self.label_embedding.weight])
         model2_input_label_embed = model2_input_label_embed.masked_fill(~mask.unsqueeze(-1), 0)
 
-        word_represent = self.wordrep(word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
-                                      char_seq_recover)
+        if word_represent is None or not self.share_wordrep:
+            with phase('wordrep'):
+                word_represent = self.wordrep(word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
+                                              char_seq_recover)
         word_represent = self.word2hidden(word_represent)
         model2_input_label_embed = self.label2hidden(model2_input_label_embed)
 
         if self.use_memory:
-            self.memory.put(lstm_out.detach(), model2_input_label_embed.detach(), word_idx)
+            with phase('Memory.put'):
+                self.memory.put(lstm_out.detach(), model2_input_label_embed.detach(), doc_idx, word_idx, word_inputs)
 
-        hh, hl, _ = self.encoder(word_represent, model2_input_label_embed, mask,  self.memory if self.use_memory else None,  doc_idx, word_idx)
+        hidden = [] if self.exit_heads is not None else None
+        with phase('encoder'):
+            hh, hl, _ = self.encoder(word_represent, model2_input_label_embed, mask,  self.memory if self.use_memory else None,  doc_idx, word_idx,
+                                     hidden)
 
-        outs2 = self.hidden2tag(self.model2_fc_dropout(torch.cat([hh, hl], -1)))
+        outs2 = self.classify2(hh, hl, mask)
 
         model2_preds = self.decode_seq(outs2, mask,m1=False)
 
         predicted_seq = model1_preds.masked_fill(label_mask, 0) + model2_preds.masked_fill(~label_mask, 0)
 
-        loss1 = self.get_loss(outs1, mask, batch_label, m1=True)
-        loss2 = self.get_loss(outs2, mask, batch_label, m1=False)
-        loss = loss1 + loss2
+        loss = self.get_loss(outs2, mask, batch_label, m1=False)
+        if hidden:
+            for exit_head, (layer_hh, layer_hl) in zip(self.exit_heads, hidden):
+                outs = exit_head(self.model2_fc_dropout(torch.cat([layer_hh, layer_hl], -1)))
+                loss = loss + self.get_loss(outs, mask, batch_label, m1=True)
+        if stage1 is None:
+            loss = loss + self.get_loss(outs1, mask, batch_label, m1=True)
 
         if self.average_batch:
             loss = loss / batch_size
 
         return loss, predicted_seq
 
+    def forward_stage1(self, word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
+                       char_seq_recover):
+        '''
+        stage-1 outputs in testing period
+        :return: p, lstm_out, outs1, word_represent
+        '''
+        with phase('mcmodel'):
+            if self.uncertainty_mode == 'moment':
+                return self.mcmodel.moment_propagation(word_inputs, feature_inputs, word_seq_lengths, char_inputs,
+                                                       char_seq_lengths, char_seq_recover)
+            return self.mcmodel.MC_sampling(word_inputs, feature_inputs, word_seq_lengths, char_inputs,
+                                            char_seq_lengths, char_seq_recover, self.nsamples,
+                                            self.mc_round, self.mc_tol)
+
+    def online_stage1(self, word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
+                      char_seq_recover, mask, doc_idx, word_idx):
+        '''
+        online decoding: stage 1 of newly arrived sentences, their memory entries are appended right away so that
+        stage 2 of any sentence can read them.
+        :return: (p, lstm_out), to be passed as `stage1` to forward(..., online=True)
+        '''
+        mask = mask.eq(1)
+        p, lstm_out, _, _ = self.forward_stage1(word_inputs, feature_inputs, word_seq_lengths, char_inputs,
+                                                char_seq_lengths, char_seq_recover)
+        if self.use_memory:
+            _, _, label_embed = stage1_head(p, p, mask, self.label_embedding.weight, self.threshold)
+            with phase('Memory.put'):
+                self.memory.append(lstm_out, self.label2hidden(label_embed), doc_idx, word_idx, word_inputs)
+        return p, lstm_out
+
     def forward(self, word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths, char_seq_recover,
-                mask, doc_idx,  word_idx):
+                mask, doc_idx,  word_idx, stage1=None, online=False):
+        '''
+        :param stage1: (p, lstm_out) from a stage-1 cache or online_stage1, model1 is not run when given
+        :param online: the memory was already filled by online_stage1
+        '''
         mask = mask.eq(1)
+        compiled = self.compiled if self.compiled is not None else {}
 
         # stage 1: forward model1 to generate draft labels and uncertainty
-        p, lstm_out, outs1, _ = self.mcmodel.MC_sampling(word_inputs, feature_inputs, word_seq_lengths,
-                                                                      char_inputs,
-                                                                      char_seq_lengths, char_seq_recover, self.nsamples)
-
-        model1_preds = self.decode_seq(outs1, mask, m1=True)
-        uncertainty = epistemic_uncertainty(p, mask)
-        label_mask = generate_label_mask(uncertainty, mask, threshold=self.threshold)
+        if stage1 is not None:
+            (p, lstm_out), outs1, word_represent = stage1, stage1[0], None
+        else:
+            p, lstm_out, outs1, word_represent = self.forward_stage1(word_inputs, feature_inputs, word_seq_lengths,
+                                                                     char_inputs, char_seq_lengths, char_seq_recover)
+
+        model1_preds, label_mask, model2_input_label_embed = compiled.get('stage1_head', stage1_head)(
+            p, outs1, mask, self.label_embedding.weight, self.threshold)
+        if self.train_stage == 'model1':
+            return model1_preds
+
+        # all draft labels are kept when no token is uncertain
+        routed = label_mask.any(-1)  # sentences with uncertain tokens
+        num_routed = int(routed.sum()) if self.skip_stage2 else routed.size(0)
+        self.stage2_stats[1] += 1
+        self.stage2_stats[2] += num_routed
+        self.stage2_stats[3] += routed.size(0)
+        if num_routed == 0:
+            if self.use_memory and self.memory.corpus is not None and not online:
+                # the corpus memory is fed from every batch, not only from those that run stage 2
+                with phase('Memory.put'):
+                    self.memory.update_corpus(lstm_out, self.label2hidden(model2_input_label_embed), word_idx,
+                                              word_inputs)
+            return model1_preds
+        self.stage2_stats[0] += 1
 
         # stage 2: forward model2 to get final labels
-        model2_input_label_embed = torch.einsum("bsc,cd->bsd", [p, self.label_embedding.weight])
-        model2_input_label_embed = model2_input_label_embed.masked_fill(~mask.unsqueeze(-1), 0)
-        word_represent = self.wordrep(word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
-                                      char_seq_recover)
-        word_represent = self.word2hidden(word_represent)
+        if word_represent is None or not self.share_wordrep:
+            with phase('wordrep'):
+                word_represent = self.wordrep(word_inputs, feature_inputs, word_seq_lengths, char_inputs, char_seq_lengths,
+                                              char_seq_recover)
         model2_input_label_embed = self.label2hidden(model2_input_label_embed)
 
-        if self.use_memory:
-            self.memory.put(lstm_out,model2_input_label_embed, word_idx)
-
-        hh, hl, attn = self.encoder(word_represent, model2_input_label_embed, mask, self.memory if self.use_memory else None,
-                                    doc_idx,
-                                    word_idx)
+        # the memory is filled from all sentences
+        if self.use_memory and not online:
+            with phase('Memory.put'):
+                self.memory.put(lstm_out,model2_input_label_embed, doc_idx, word_idx, word_inputs)
+
+        # the encoder only runs on the routed sentences, trimmed to their max length
+        if num_routed < routed.size(0):
+            rows = routed.nonzero().squeeze(-1)
+            routed_len = int(mask[rows].sum(-1).max())
+            word_represent = word_represent[rows, :routed_len]
+            model2_input_label_embed = model2_input_label_embed[rows, :routed_len]
+            routed_mask = mask[rows, :routed_len]
+            doc_idx, word_idx = doc_idx[rows], word_idx[rows, :routed_len]
+        else:
+            routed_mask = mask
+        word_represent = self.word2hidden(word_represent)
 
-        outs2 = self.hidden2tag(self.model2_fc_dropout(torch.cat([hh, hl], -1)))
-        model2_preds = self.decode_seq(outs2, mask, m1=False)
-
-        predicted_seq = model1_preds.masked_fill(label_mask, 0) + model2_preds.masked_fill(~label_mask, 0)
+        exit_outs = None
+        with phase('encoder'):
+            if self.exit_heads is not None and self.early_exit_threshold > 0:
+                hh, hl, exit_outs, exit_layer = self.encoder.forward_early_exit(
+                    word_represent, model2_input_label_embed, routed_mask, self.memory if self.use_memory else None,
+                    doc_idx, word_idx, self.exit_heads, self.early_exit_threshold)
+                self.exit_stats[0] += int(exit_layer.sum()) + exit_layer.size(0)
+            else:
+                hh, hl, _ = self.encoder(word_represent, model2_input_label_embed, routed_mask, self.memory if self.use_memory else None,
+                                            doc_idx,
+                                            word_idx)
+                self.exit_stats[0] += len(self.encoder.layers) * hh.size(0)
+            self.exit_stats[1] += hh.size(0)
+
+        outs2 = self.classify2(hh, hl, routed_mask)
+        model2_preds = self.decode_seq(outs2, routed_mask, m1=False)
+        if exit_outs is not None:
+            exited = exit_layer < len(self.encoder.layers) - 1
+            model2_preds = torch.where(exited[:, None], self.decode_seq(exit_outs, routed_mask, m1=True), model2_preds)
+        if num_routed < routed.size(0):
+            model2_preds = model1_preds.new_zeros(model1_preds.size()).index_put_(
+                (rows[:, None], torch.arange(routed_len, device=rows.device)[None, :]), model2_preds)
+
+        predicted_seq = compiled.get('merge', merge_predictions)(model1_preds, model2_preds, label_mask)
 
         return predicted_seq
 
+    def compile_inference(self, mode):
+        '''
+        compile the inference graph, only used in eval mode.
+        :param mode: 'script' compiles the stage-1 head and the decode merge with TorchScript,
+            'compile' additionally wraps the stage-1 lstm stack and the stage-2 transformer layers with torch.compile.
+        '''
+        self.compiled = {'stage1_head': CompiledFunction(stage1_head, mode, 'stage1_head'),
+                         'merge': CompiledFunction(merge_predictions, mode, 'merge')}
+        if mode == 'compile':
+            self.mcmodel.compiled_rest = CompiledFunction(self.mcmodel.forward_rest, mode, 'mcmodel')
+            for i, layer in enumerate(self.encoder.layers):
+                layer.compiled_forward = CompiledFunction(layer.forward, mode, 'transformer layer %d' % i)
+
+    def classify2(self, hh, hl, mask):
+        '''
+        model2 label scores, with varlen_encoder only computed at the unpadded positions (0 elsewhere)
+        '''
+        feats = torch.cat([hh, hl], -1)
+        if not self.varlen_encoder:
+            return self.hidden2tag(self.model2_fc_dropout(feats))
+        outs = self.hidden2tag(self.model2_fc_dropout(feats[mask]))
+        return outs.new_zeros(mask.size() + (outs.size(-1),)).masked_scatter(mask.unsqueeze(-1), outs)
+
     def decode_seq(self, outs, mask, m1=False):
         if self.use_crf and not m1:
             scores, preds = self.crf._viterbi_decode(outs, mask)
@@ -201,6 +362,30 @@ def epistemic_uncertainty(p, mask):
     return hp
 
 
+def stage1_head(p, outs1, mask, label_weight, threshold):
+    # type: (Tensor, Tensor, Tensor, Tensor, float) -> Tuple[Tensor, Tensor, Tensor]
+    '''
+    draft labels, uncertain positions and label embedding input of model2 from the stage-1 distribution
+    :param p: (batch, max_seq_len, num_labels)
+    :param outs1: (batch, max_seq_len, num_labels)
+    :param mask: (batch, max_seq_len) BoolTensor
+    :param label_weight: (num_labels, label_embed_dim)
+    :param threshold: positions with uncertainty above it take labels from the second stage
+    :return: model1_preds (batch, max_seq_len), label_mask (batch, max_seq_len),
+        label_embed (batch, max_seq_len, label_embed_dim)
+    '''
+    model1_preds = outs1.argmax(-1).masked_fill(~mask, 0)
+    uncertainty = epistemic_uncertainty(p, mask)
+    label_mask = (uncertainty > threshold).masked_fill(~mask, False)
+    label_embed = torch.einsum("bsc,cd->bsd", [p, label_weight])
+    label_embed = label_embed.masked_fill(~mask.unsqueeze(-1), 0.)
+    return model1_preds, label_mask, label_embed
+
+
+def merge_predictions(model1_preds, model2_preds, label_mask):
+    return model1_preds.masked_fill(label_mask, 0) + model2_preds.masked_fill(~label_mask, 0)
+
+
 def generate_label_mask(hp, mask, topk=None, threshold=None):
     assert topk is not None or threshold is not None, "Must set topk or threshold!"
     if topk is not None:
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 from torch import nn
 import math
 from copy import deepcopy
+from utils.telemetry import phase
+from .checkpoint import checkpoint
 
 
 def make_positions(tensor, padding_idx):
@@ -207,6 +209,24 @@ class RelativePositionalEmbedding(nn.Module):
         return embed
 
 
+def is_compiling():
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+
+def use_sdpa(attn_impl, q_len=2):
+    '''
+    whether an attention module runs the fused F.scaled_dot_product_attention kernel
+    :param attn_impl: 'sdpa' uses it when this torch provides it, 'math' always runs matmul + softmax, 'auto' uses
+        it unless every row has a single query: then there is no q_len x k_len matrix to save and the math kernel is
+        faster
+    :param q_len: number of queries of a row
+    '''
+    if attn_impl == 'math' or not hasattr(F, 'scaled_dot_product_attention'):
+        return False
+    return attn_impl == 'sdpa' or q_len > 1
+
+
 class RelativeMultiHeadAttn(nn.Module):
     def __init__(self, d_model, n_head, dropout, r_w_bias=None, r_r_bias=None, scale=True, rel_pos_embed='sin',
                  padding_idx=0):
@@ -242,6 +262,10 @@ class RelativeMultiHeadAttn(nn.Module):
         else:
             self.scale = 1
 
+        self.query_chunk = 0  # queries per chunk of the relative-position term, 0 for all at once
+        self._r_cache = {}  # max_len -> r in inference, valid while the weights match _r_cache_key
+        self._r_cache_key = None
+
         if r_r_bias is None or r_w_bias is None:  # Biases are not shared
             self.r_r_bias = nn.Parameter(nn.init.xavier_normal_(torch.zeros(n_head, d_model // n_head)))
             self.r_w_bias = nn.Parameter(nn.init.xavier_normal_(torch.zeros(n_head, d_model // n_head)))
@@ -259,8 +283,7 @@ class RelativeMultiHeadAttn(nn.Module):
         """
 
         batch_size, max_len, d_model = q.size()
-        pos_embed = self.pos_embed(mask)  # 2*max_len, d
-        r = self.r_linear(pos_embed)  # 2*max_len, d
+        r = self.rel_pos(mask)  # 2*max_len, d
 
         q = self.q_linear(q)  # batch_size x max_len x d_model
         kv = self.kv_linear(k)
@@ -273,11 +296,7 @@ class RelativeMultiHeadAttn(nn.Module):
         rw_head_q = q + self.r_r_bias[:, None]
         AC = torch.einsum('bnqd,bnkd->bnqk', rw_head_q, k)  # b x n_head x max_len x d_model, n = head
 
-        D_ = torch.einsum('nd,ld->nl', self.r_w_bias, r)[None, :, None]  # head x 2max_len,
-        B_ = torch.einsum('bnqd,ld->bnql', q, r)  # bsz x head  x max_len x 2max_len，
-        BD = B_ + D_  # bsz x head x max_len x 2max_len
-        BD = self._shift(BD)  # bsz x head x max_len x max_len
-        attn = AC + BD
+        attn = self._rel_term(q, r, AC)  # AC + BD
 
         attn = attn / self.scale  # batch, n_head, seq_len, seq_len
 
@@ -288,26 +307,91 @@ class RelativeMultiHeadAttn(nn.Module):
 
         return v, attn
 
-    def _shift(self, BD):
+    def rel_pos(self, mask):
+        """
+        r_linear(pos_embed(mask)), which only depends on max_len and the weights. in inference (no grad) it is cached
+        per max_len, the cache is dropped when r_linear or the position embedding is updated in place, reloaded or
+        moved.
+
+        :param mask: batch_size x max_len x max_len
+        :return: 2max_len x head_dim
+        """
+        if torch.is_grad_enabled() or is_compiling():
+            return self.r_linear(self.pos_embed(mask))
+        key = tuple((w._version, w.data_ptr(), w.device, w.dtype) for w in
+                    [self.r_linear.weight] + list(self.pos_embed.parameters()) + list(self.pos_embed.buffers()))
+        if key != self._r_cache_key:
+            self._r_cache = {}
+            self._r_cache_key = key
+        max_len = mask.size(1)
+        if max_len not in self._r_cache:
+            self._r_cache[max_len] = self.r_linear(self.pos_embed(mask))
+        return self._r_cache[max_len]
+
+    def _rel_term(self, q, r, AC=None):
         """
-        example:
-        -3 -2 -1 0 1 2
-        -3 -2 -1 0 1 2
-        -3 -2 -1 0 1 2
-        to
-        0   1  2
-        -1  0  1
-        -2 -1  0
-
-        :param BD: batch_size x n_head x max_len x 2max_len
+        relative-position term BD[i, j] = (q_i + r_w_bias) . r[j - i + max_len], computed directly in
+        max_len x max_len form (chunked over queries with query_chunk), added to AC if given.
+        equivalent to shifting the max_len x 2max_len scores B_ + D_ (see tests/rel_shift.py) without materializing
+        them.
+
+        :param q: batch_size x n_head x max_len x head_dim
+        :param r: 2max_len x head_dim
         :return: batch_size x n_head x max_len x max_len
         """
-        bsz, n_head, max_len, _ = BD.size()
-        zero_pad = BD.new_zeros(bsz, n_head, max_len, 1)
-        BD = torch.cat([BD, zero_pad], dim=-1).view(bsz, n_head, -1, max_len)  # bsz x n_head x (2max_len+1) x max_len
-        BD = BD[:, :, :-1].view(bsz, n_head, max_len, -1)  # bsz x n_head x 2max_len x max_len
-        BD = BD[:, :, :, max_len:]
-        return BD
+        bsz, n_head, max_len, head_dim = q.size()
+        q = (q + self.r_w_bias[:, None]).reshape(bsz * n_head, max_len, head_dim).transpose(0, 1)  # max_len x bn x d
+        chunk = self.query_chunk if self.query_chunk > 0 else max_len
+        pos = torch.arange(max_len, device=q.device)
+        out = [] if AC is None else None
+        for start in range(0, max_len, chunk):
+            end = min(start + chunk, max_len)
+            r_idx = pos[None, :] - pos[start:end, None] + max_len  # chunk x max_len
+            BD = torch.bmm(q[start:end], r[r_idx].transpose(1, 2))  # chunk x bn x max_len
+            BD = BD.transpose(0, 1).reshape(bsz, n_head, end - start, max_len)
+            if AC is None:
+                out.append(BD)
+            else:
+                AC[:, :, start:end] += BD
+        return torch.cat(out, 2) if AC is None else AC
+
+
+def dual_relative_attn(attn_a, attn_b, q, k_a, k_b, mask):
+    """
+    attn_a(q, k_a, mask) and attn_b(q, k_b, mask) of two RelativeMultiHeadAttn of the same shape, computed as one
+    attention with 2 x n_head heads: the two query projections run as one matmul over their concatenated weights, and
+    the content scores, softmax and value products are batched over both. the parameters stay in attn_a / attn_b.
+
+    :param q: batch_size x max_len x d_model
+    :param mask: batch_size x max_len x max_len
+    :return: (v_a, attn_a), (v_b, attn_b)
+    """
+    batch_size, max_len, d_model = q.size()
+    n_head = attn_a.n_head
+    r_a = attn_a.rel_pos(mask)
+    r_b = attn_b.rel_pos(mask)
+
+    q = F.linear(q, torch.cat([attn_a.q_linear.weight, attn_b.q_linear.weight], 0))  # batch_size x max_len x 2d_model
+    k_a, v_a = torch.chunk(attn_a.kv_linear(k_a), chunks=2, dim=-1)
+    k_b, v_b = torch.chunk(attn_b.kv_linear(k_b), chunks=2, dim=-1)
+
+    q = q.view(batch_size, max_len, 2 * n_head, -1).transpose(1, 2)  # b x 2n_head x max_len x head_dim
+    k = torch.cat([k_a, k_b], -1).view(batch_size, max_len, 2 * n_head, -1).transpose(1, 2)
+    v = torch.cat([v_a, v_b], -1).view(batch_size, max_len, 2 * n_head, -1).transpose(1, 2)
+
+    r_r_bias = torch.cat([attn_a.r_r_bias, attn_b.r_r_bias], 0)
+    AC = torch.einsum('bnqd,bnkd->bnqk', q + r_r_bias[:, None], k)
+    # the relative-position term of each half is added in place
+    attn_a._rel_term(q[:, :n_head], r_a, AC[:, :n_head])
+    attn_b._rel_term(q[:, n_head:], r_b, AC[:, n_head:])
+
+    attn = AC / attn_a.scale
+    attn = attn.masked_fill(mask[:, None, :, :].eq(0), float('-inf'))
+    attn = F.softmax(attn, dim=-1)
+    v = torch.matmul(attn_a.dropout_layer(attn), v).transpose(1, 2)  # b x max_len x 2n_head x head_dim
+    v_a = v[:, :, :n_head].reshape(batch_size, max_len, d_model)
+    v_b = v[:, :, n_head:].reshape(batch_size, max_len, d_model)
+    return (v_a, attn[:, :n_head]), (v_b, attn[:, n_head:])
 
 
 class MultiHeadAttn(nn.Module):
@@ -329,31 +413,43 @@ class MultiHeadAttn(nn.Module):
             self.scale = math.sqrt(d_model // n_head)
         else:
             self.scale = 1
+        self.attn_impl = 'auto'
 
     def forward(self, x, k, mask):
         """
 
-        :param x: bsz x max_len x d_model
-        :param mask: bsz x max_len
-        :return:
+        :param x: bsz x max_len x d_model, the queries
+        :param k: bsz x max_len x d_model, the keys and values
+        :param mask: bsz x max_len x max_len
+        :return: bsz x max_len x d_model, the attention weights (None with the fused kernel)
         """
         batch_size, max_len, d_model = x.size()
-        x = self.qkv_linear(x)
-        q, k, v = torch.chunk(x, 3, dim=-1)
+        if k is x:
+            q, k, v = torch.chunk(self.qkv_linear(x), 3, dim=-1)
+        else:
+            q = F.linear(x, self.qkv_linear.weight[:d_model], self.qkv_linear.bias[:d_model])
+            k, v = torch.chunk(F.linear(k, self.qkv_linear.weight[d_model:], self.qkv_linear.bias[d_model:]), 2, dim=-1)
         q = q.view(batch_size, max_len, self.n_head, -1).transpose(1, 2)
-        k = k.view(batch_size, max_len, self.n_head, -1).permute(0, 2, 3, 1)
+        k = k.view(batch_size, max_len, self.n_head, -1).transpose(1, 2)
         v = v.view(batch_size, max_len, self.n_head, -1).transpose(1, 2)
 
-        attn = torch.matmul(q, k)  # batch_size x n_head x max_len x max_len
+        if use_sdpa(self.attn_impl, max_len):
+            # the kernel scales by 1/sqrt(head_dim)
+            q = q * (math.sqrt(q.size(-1)) / self.scale)
+            v = F.scaled_dot_product_attention(q, k, v, attn_mask=mask[:, None].bool(),
+                                               dropout_p=self.dropout_layer.p if self.training else 0.)
+            return v.transpose(1, 2).reshape(batch_size, max_len, -1), None
+
+        attn = torch.matmul(q, k.transpose(2, 3))  # batch_size x n_head x max_len x max_len
         attn = attn / self.scale
-        attn.masked_fill_(mask=mask[:, None, None].eq(0), value=float('-inf'))
+        attn.masked_fill_(mask=mask[:, None].eq(0), value=float('-inf'))
 
         attn = F.softmax(attn, dim=-1)  # batch_size x n_head x max_len x max_len
         attn = self.dropout_layer(attn)
         v = torch.matmul(attn, v)  # batch_size x n_head x max_len x d_model//n_head
         v = v.transpose(1, 2).reshape(batch_size, max_len, -1)
 
-        return v
+        return v, attn
 
 
 class TransformerLayer(nn.Module):
@@ -379,6 +475,8 @@ class TransformerLayer(nn.Module):
             self.self_attn_hl = deepcopy(self_attn)
 
         self.after_norm = after_norm
+        # the hh and hl attention of the last layer run as one attention with 2 x n_head heads
+        self.fuse_last = last_layer and isinstance(self_attn, RelativeMultiHeadAttn)
 
         self.ffn = nn.Sequential(nn.Linear(d_model, feedforward_dim),
                                  nn.ReLU(),
@@ -386,6 +484,7 @@ class TransformerLayer(nn.Module):
                                  nn.Linear(feedforward_dim, d_model),
                                  nn.Dropout(dropout),
                                  )
+        self.compiled_forward = None
 
     def forward(self, h, l, mask):
         """
@@ -399,7 +498,11 @@ class TransformerLayer(nn.Module):
         residual_h = h
 
         hh_mask = mask[:, None, :].expand(batch_size, max_len, max_len)
-        attn_out_hh, _ = self.self_attn_hh(h, h, hh_mask)
+        if self.fuse_last:
+            (attn_out_hh, _), (attn_out_hl, attn) = dual_relative_attn(self.self_attn_hh, self.self_attn_hl, h, h, l,
+                                                                       hh_mask)
+        else:
+            attn_out_hh, _ = self.self_attn_hh(h, h, hh_mask)
         attn_out_hh = attn_out_hh.masked_fill(mask.unsqueeze(-1) == 0, 0)
 
         hh = attn_out_hh + residual_h
@@ -415,7 +518,8 @@ class TransformerLayer(nn.Module):
         if not self.last_layer:
             return hh, l, None
 
-        attn_out_hl, attn = self.self_attn_hl(h, l, hh_mask)  # batch, seq_len, d_model
+        if not self.fuse_last:
+            attn_out_hl, attn = self.self_attn_hl(h, l, hh_mask)  # batch, seq_len, d_model
         hl = attn_out_hl.masked_fill(mask.unsqueeze(-1) == 0, 0)
 
         return hh, hl, attn
@@ -447,14 +551,85 @@ class TransformerEncoder(nn.Module):
 
         self.h2dmodel = nn.Linear(d_model * 2, d_model)
         self.l2dmodel = nn.Linear(d_model * 2, d_model)
+        self.varlen = False  # run buckets of sentences of similar length, see forward_varlen
+        self.varlen_min_saving = 128
+        self.checkpoint = False  # activation checkpointing of every layer in training
+
+    def set_attn_impl(self, attn_impl):
+        '''
+        :param attn_impl: 'auto', 'sdpa' or 'math', see use_sdpa. the relative attention always runs its own kernels
+        '''
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttn):
+                module.attn_impl = attn_impl
 
-    def forward(self, h, l, mask, memory,  doc_idx, word_idx):
+    def forward(self, h, l, mask, memory,  doc_idx, word_idx, hidden=None):
         """
 
         :param x: batch_size x max_len x d_model
         :param mask: batch_size x max_len
+        :param hidden: see forward_padded
         :return:
         """
+        if self.varlen and mask.size(0) > 1:
+            return self.forward_varlen(h, l, mask, memory, doc_idx, word_idx, hidden)
+        return self.forward_padded(h, l, mask, memory, doc_idx, word_idx, hidden)
+
+    def buckets(self, mask):
+        '''
+        sentences are sorted by length (longest first) and grouped into buckets. a bucket is closed before sentence
+        `end` once starting a new one there saves at least varlen_min_saving padded positions, i.e. when
+        (bucket length - length of sentence end) * (number of sentences from end on) >= varlen_min_saving.
+        :return: list of (rows, bucket_len), rows: indices of the sentences of the bucket, bucket_len: their max length
+        '''
+        batch_size = mask.size(0)
+        sorted_lens, order = mask.long().sum(-1).sort(descending=True)
+        sorted_lens = sorted_lens.tolist()
+        buckets = []
+        start = 0
+        while start < batch_size:
+            bucket_len = sorted_lens[start]
+            end = start + 1
+            while end < batch_size and (bucket_len - sorted_lens[end]) * (batch_size - end) < self.varlen_min_saving:
+                end += 1
+            buckets.append((order[start:end], bucket_len))
+            start = end
+        return buckets
+
+    def forward_varlen(self, h, l, mask, memory, doc_idx, word_idx, hidden=None):
+        """
+        padding-free execution: each bucket of sentences of similar length (see buckets) runs trimmed to its own max
+        length. every token only attends within its sentence, so the outputs at the unpadded positions are those of
+        forward_padded; padded positions are 0.
+
+        :param hidden: see forward_padded, the layer outputs are stitched back to batch_size x max_len
+        :return: hh, hl as forward_padded, and None instead of the attention weights, which would need the padded
+            batch_size x n_head x max_len x max_len tensor this path avoids
+        """
+        batch_size, max_len = mask.size()[:2]
+        hh = h.new_zeros(batch_size, max_len, h.size(-1))
+        hl = l.new_zeros(batch_size, max_len, l.size(-1))
+        layers = [[hh, hl] for _ in range(len(self.layers) - 1)] if hidden is not None else None
+        for rows, bucket_len in self.buckets(mask):
+            pos = (rows[:, None], torch.arange(bucket_len, device=rows.device)[None, :])
+            bucket_hidden = [] if hidden is not None else None
+            bucket_hh, bucket_hl, _ = self.forward_padded(
+                h[rows, :bucket_len], l[rows, :bucket_len], mask[rows, :bucket_len], memory, doc_idx[rows],
+                word_idx[rows, :bucket_len], bucket_hidden)
+            hh = hh.index_put(pos, bucket_hh)
+            hl = hl.index_put(pos, bucket_hl)
+            if hidden is not None:
+                for layer, (layer_hh, layer_hl) in zip(layers, bucket_hidden):
+                    layer[0] = layer[0].index_put(pos, layer_hh)
+                    layer[1] = layer[1].index_put(pos, layer_hl)
+        if hidden is not None:
+            hidden.extend(tuple(layer) for layer in layers)
+        return hh, hl, None
+
+    def forward_padded(self, h, l, mask, memory,  doc_idx, word_idx, hidden=None):
+        '''
+        :param hidden: if a list is given, the (hh, hl) outputs of every layer but the last are appended to it
+        '''
         if self.pos_embed is not None:
             h = h + self.pos_embed(mask)
             l = l + self.pos_embed(mask)
@@ -462,10 +637,97 @@ class TransformerEncoder(nn.Module):
         hh, hl = h, l
         for i, layer in enumerate(self.layers):
             if memory is not None and i == len(self.layers) - 1:
-                h_mem, l_mem = memory.get(hh,  doc_idx, word_idx)
+                with phase('Memory.get'):
+                    h_mem, l_mem = memory.get(hh,  doc_idx, word_idx)
 
                 hh = self.h2dmodel(torch.cat([hh, h_mem], -1))
                 hl = self.l2dmodel(torch.cat([hl, l_mem], -1))
-            hh, hl, attn = layer(hh, hl, mask)
+            if layer.compiled_forward is not None and not self.training:
+                hh, hl, attn = layer.compiled_forward(hh, hl, mask)
+            elif self.checkpoint and self.training and torch.is_grad_enabled():
+                hh, hl, attn = checkpoint(layer, hh, hl, mask)
+            else:
+                hh, hl, attn = layer(hh, hl, mask)
+            if hidden is not None and i < len(self.layers) - 1:
+                hidden.append((hh, hl))
         return hh, hl, attn
 
+    def forward_early_exit(self, h, l, mask, memory, doc_idx, word_idx, exit_heads, threshold):
+        """
+        see forward_early_exit_padded, with varlen every bucket (see buckets) exits on its own
+        """
+        if not self.varlen or mask.size(0) == 1:
+            return self.forward_early_exit_padded(h, l, mask, memory, doc_idx, word_idx, exit_heads, threshold)
+        batch_size, max_len = mask.size()[:2]
+        hh = h.new_zeros(batch_size, max_len, h.size(-1))
+        hl = l.new_zeros(batch_size, max_len, l.size(-1))
+        exit_outs = None
+        exit_layer = mask.new_full((batch_size,), len(self.layers) - 1, dtype=torch.long)
+        for rows, bucket_len in self.buckets(mask):
+            pos = (rows[:, None], torch.arange(bucket_len, device=rows.device)[None, :])
+            bucket_hh, bucket_hl, bucket_outs, exit_layer[rows] = self.forward_early_exit_padded(
+                h[rows, :bucket_len], l[rows, :bucket_len], mask[rows, :bucket_len], memory, doc_idx[rows],
+                word_idx[rows, :bucket_len], exit_heads, threshold)
+            hh = hh.index_put(pos, bucket_hh)
+            hl = hl.index_put(pos, bucket_hl)
+            if bucket_outs is not None:
+                if exit_outs is None:
+                    exit_outs = bucket_outs.new_zeros((batch_size, max_len, bucket_outs.size(-1)))
+                exit_outs = exit_outs.index_put(pos, bucket_outs)
+        return hh, hl, exit_outs, exit_layer
+
+    def forward_early_exit_padded(self, h, l, mask, memory, doc_idx, word_idx, exit_heads, threshold):
+        """
+        inference with early exit: after every layer but the last, exit_heads[i] labels the remaining sentences from
+        [hh; hl], a sentence leaves the encoder once every token of it gets a label with probability >= threshold.
+        the remaining sentences run the next layers (and the memory read) without it.
+
+        :param exit_heads: num_layers - 1 modules mapping batch_size x max_len x 2d_model to label scores
+        :return: hh, hl: batch_size x max_len x d_model, 0 for the sentences that exited,
+            exit_outs: batch_size x max_len x num_labels, label scores of the sentences that exited (None if none did),
+            exit_layer: (batch_size, ) index of the layer after which each sentence left, num_layers - 1 if it ran all
+        """
+        batch_size, max_len = mask.size()[:2]
+        num_layers = len(self.layers)
+        if self.pos_embed is not None:
+            h = h + self.pos_embed(mask)
+            l = l + self.pos_embed(mask)
+
+        rows = torch.arange(batch_size, device=mask.device)  # sentences still in the encoder
+        exit_layer = rows.new_full((batch_size,), num_layers - 1)
+        exit_outs = None
+        hh, hl = h, l
+        for i, layer in enumerate(self.layers):
+            if memory is not None and i == num_layers - 1:
+                with phase('Memory.get'):
+                    h_mem, l_mem = memory.get(hh, doc_idx[rows], word_idx[rows])
+
+                hh = self.h2dmodel(torch.cat([hh, h_mem], -1))
+                hl = self.l2dmodel(torch.cat([hl, l_mem], -1))
+            if layer.compiled_forward is not None and not self.training:
+                hh, hl, _ = layer.compiled_forward(hh, hl, mask[rows])
+            else:
+                hh, hl, _ = layer(hh, hl, mask[rows])
+            if i == num_layers - 1:
+                break
+
+            outs = exit_heads[i](torch.cat([hh, hl], -1))
+            confidence = F.softmax(outs, -1).max(-1)[0].masked_fill(mask[rows] == 0, 1)
+            done = (confidence >= threshold).all(-1)
+            if not done.any():
+                continue
+            if exit_outs is None:
+                exit_outs = outs.new_zeros((batch_size, max_len, outs.size(-1)))
+            exit_outs[rows[done]] = outs[done]
+            exit_layer[rows[done]] = i
+            rows, hh, hl = rows[~done], hh[~done], hl[~done]
+            if rows.numel() == 0:
+                break
+
+        out_hh = h.new_zeros((batch_size, max_len, h.size(-1)))
+        out_hl = l.new_zeros((batch_size, max_len, l.size(-1)))
+        if rows.numel() > 0:
+            out_hh[rows] = hh
+            out_hl[rows] = hl
+        return out_hh, out_hl, exit_outs, exit_layer
+
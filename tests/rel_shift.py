@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Reference implementation of RelativeMultiHeadAttn._rel_term through the max_len x 2max_len scores and a shift, as
+the relative attention computed it before. Used by the tests and the `relattn` benchmark.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+import torch
+
+
+def rel_term_shift(attn, q, r, AC=None):
+    """
+    :param attn: RelativeMultiHeadAttn
+    :param q: batch_size x n_head x max_len x head_dim
+    :param r: 2max_len x head_dim
+    :return: batch_size x n_head x max_len x max_len, added to AC if given
+    """
+    D_ = torch.einsum('nd,ld->nl', attn.r_w_bias, r)[None, :, None]  # head x 2max_len,
+    B_ = torch.einsum('bnqd,ld->bnql', q, r)  # bsz x head  x max_len x 2max_len，
+    BD = B_ + D_  # bsz x head x max_len x 2max_len
+    BD = shift(BD)  # bsz x head x max_len x max_len
+    return BD if AC is None else AC + BD
+
+
+def shift(BD):
+    """
+    example:
+    -3 -2 -1 0 1 2
+    -3 -2 -1 0 1 2
+    -3 -2 -1 0 1 2
+    to
+    0   1  2
+    -1  0  1
+    -2 -1  0
+
+    :param BD: batch_size x n_head x max_len x 2max_len
+    :return: batch_size x n_head x max_len x max_len
+    """
+    bsz, n_head, max_len, _ = BD.size()
+    zero_pad = BD.new_zeros(bsz, n_head, max_len, 1)
+    BD = torch.cat([BD, zero_pad], dim=-1).view(bsz, n_head, -1, max_len)  # bsz x n_head x (2max_len+1) x max_len
+    BD = BD[:, :, :-1].view(bsz, n_head, max_len, -1)  # bsz x n_head x 2max_len x max_len
+    BD = BD[:, :, :, max_len:]
+    return BD
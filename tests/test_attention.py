@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the fused (scaled_dot_product_attention) and the math attention kernels, in eval and in training.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from model.memory import Memory
+from model.transformer import MultiHeadAttn
+
+pytestmark = pytest.mark.skipif(not hasattr(F, 'scaled_dot_product_attention'),
+                                reason='torch has no scaled_dot_product_attention')
+
+
+def build_memory(n_head):
+    '''a memory over two documents of 6 and 9 words, every third word has no neighbour'''
+    rng = np.random.RandomState(0)
+    word_mat = []
+    for num_words in [6, 9]:
+        mat = np.zeros((num_words + 1, 4), dtype=np.int64)
+        for w in range(1, num_words + 1):
+            if w % 3:
+                mat[w, :3] = rng.choice(num_words, 3, replace=False) + 1
+        word_mat.append(mat)
+    data = SimpleNamespace(word_mat=word_mat, HP_hidden_dim=16, d_model=16, HP_memory_attn_nhead=n_head,
+                           HP_max_read_memory=4, HP_memory_topk=0, HP_corpus_memory_size=0)
+    memory = Memory(data)
+    memory.attn.dropout_layer.p = 0.  # the kernels draw different dropout masks
+    return memory
+
+
+def run_memory(memory, attn_impl, training):
+    memory.attn.attn_impl = attn_impl
+    memory.train(training)
+    memory.zero_grad()
+    torch.manual_seed(1)
+    doc_idx = torch.tensor([0, 1])
+    word_idx = torch.tensor([[1, 2, 3, 4, 5, 6, 0, 0, 0], list(range(1, 10))])
+    memory.put(torch.randn(2, 9, 16), torch.randn(2, 9, 16), doc_idx, word_idx)
+    query = torch.randn(2, 9, 16, requires_grad=True)
+    h, l = memory.get(query, doc_idx, word_idx)
+    if training:
+        (h * torch.randn_like(h)).sum().backward(retain_graph=True)
+        (l * torch.randn_like(l)).sum().backward()
+    grads = [query.grad] + [p.grad for p in memory.parameters()] if training else []
+    return [h, l] + grads
+
+
+def run_naive(attn, attn_impl, training, cross):
+    attn.attn_impl = attn_impl
+    attn.train(training)
+    attn.zero_grad()
+    torch.manual_seed(1)
+    x = torch.randn(3, 7, 32, requires_grad=True)
+    k = torch.randn(3, 7, 32) if cross else x
+    mask = (torch.arange(7)[None, :] < torch.tensor([7, 4, 1])[:, None])[:, None, :].expand(3, 7, 7)
+    v, _ = attn(x, k, mask)
+    if training:
+        (v * torch.randn_like(v)).sum().backward()
+    return [v] + ([x.grad] + [p.grad for p in attn.parameters()] if training else [])
+
+
+@pytest.mark.parametrize('training', [False, True])
+@pytest.mark.parametrize('n_head', [1, 2])
+def test_memory_attention_parity(n_head, training):
+    memory = build_memory(n_head)
+    for a, b in zip(run_memory(memory, 'math', training), run_memory(memory, 'sdpa', training)):
+        assert torch.allclose(a, b, atol=1e-5)
+
+
+@pytest.mark.parametrize('training', [False, True])
+@pytest.mark.parametrize('cross', [False, True])
+@pytest.mark.parametrize('scale', [False, True])
+def test_naive_attention_parity(scale, cross, training):
+    torch.manual_seed(0)
+    attn = MultiHeadAttn(32, 4, dropout=0., scale=scale)
+    for a, b in zip(run_naive(attn, 'math', training, cross), run_naive(attn, 'sdpa', training, cross)):
+        assert torch.allclose(a, b, atol=1e-5)
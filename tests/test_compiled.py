@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+The parity check of CompiledFunction replays the RNG state, so a compiled function with dropout is kept.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from model.compiled import CompiledFunction
+
+
+def mc_dropout(x):
+    return F.dropout(x, 0.5, training=True) * 2 + torch.rand_like(x)
+
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason='torch has no torch.compile')
+@pytest.mark.parametrize('device', ['cpu', 'cuda'])
+def test_compiled_dropout_passes_parity_check(device):
+    if device == 'cuda' and not torch.cuda.is_available():
+        pytest.skip('no cuda device')
+    fn = CompiledFunction(mc_dropout, 'compile', 'mc_dropout')
+    for num in [8, 13, 21]:
+        fn(torch.randn(4, num, device=device))
+    assert fn.compiled is not None
+    assert fn.check_calls == 0
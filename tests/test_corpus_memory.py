@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+The corpus memory is fed from every batch, also when no token is uncertain and stage 2 is skipped.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy as np
+import torch
+
+from main import get_parser, batchify_with_label
+from model.seqmodel import SeqModel
+from utils.data import Data
+
+SENTENCES = [['EU', 'rejects', 'German', 'call', 'to', 'boycott', 'British', 'lamb', '.'],
+             ['Germany', "'s", 'representative', 'to', 'the', 'European', 'Union', 'said', 'the', 'call', '.']]
+
+
+def build(threshold):
+    data = Data()
+    data.read_config(get_parser().parse_args([
+        '--hidden_dim', '16', '--d_head', '4', '--n_head', '2', '--label_embed_dim', '8', '--char_hidden_dim', '8',
+        '--word_emb_dim', '8', '--char_emb_dim', '8', '--corpus_memory_size', '100', '--threshold', str(threshold)]))
+    data.HP_gpu = False
+    data.build_alphabet('data/conll2003/dev.txt')
+    data.fix_alphabet()
+    data.build_pretrain_emb()
+
+    # one document, word_idx runs over the document and the neighbours of a word are its other mentions
+    words = [w for sent in SENTENCES for w in sent]
+    word_mat = np.zeros((len(words) + 1, data.HP_max_read_memory), dtype=np.int64)
+    for i, word in enumerate(words):
+        mentions = [j + 1 for j, other in enumerate(words) if other.lower() == word.lower() and j != i]
+        word_mat[i + 1, :len(mentions)] = mentions[:data.HP_max_read_memory]
+    data.word_mat = [word_mat]
+
+    doc, start = [], 1
+    for sent in SENTENCES:
+        doc.append([[data.word_alphabet.get_index(w) for w in sent], [[] for _ in sent],
+                    [[data.char_alphabet.get_index(c) for c in w] for w in sent],
+                    [data.label_alphabet.get_index('O') for _ in sent], list(range(start, start + len(sent))), 0])
+        start += len(sent)
+    torch.manual_seed(0)
+    return SeqModel(data), batchify_with_label([doc], False, True)
+
+
+def stored_types(model):
+    return int((model.memory.corpus.slot_type >= 0).sum())
+
+
+def test_confident_batch_feeds_corpus_memory():
+    # the uncertainty (entropy) never exceeds log(number of labels) < 5, so no sentence runs stage 2
+    model, batch = build(threshold=5.)
+    word, features, wordlen, wordrecover, char, charlen, charrecover, label, mask, doc_idx, word_idx = batch
+    model.eval()
+    with torch.no_grad():
+        model(word, features, wordlen, char, charlen, charrecover, mask, doc_idx, word_idx)
+    assert model.stage2_stats[0] == 0
+    assert stored_types(model) > 0
+
+
+def test_training_feeds_corpus_memory():
+    model, batch = build(threshold=5.)
+    word, features, wordlen, wordrecover, char, charlen, charrecover, label, mask, doc_idx, word_idx = batch
+    model.train()
+    loss, _ = model.neg_log_likelihood_loss(word, features, wordlen, char, charlen, charrecover, label, mask,
+                                            doc_idx, word_idx)
+    loss.backward()
+    assert stored_types(model) > 0
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the direct relative-position term of RelativeMultiHeadAttn and the shifted reference, in outputs and
+gradients.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pytest
+import torch
+
+from model.transformer import RelativeMultiHeadAttn
+from tests.rel_shift import rel_term_shift, shift
+
+
+def build_attn(query_chunk):
+    torch.manual_seed(0)
+    attn = RelativeMultiHeadAttn(32, 4, 0.)
+    attn.query_chunk = query_chunk
+    return attn
+
+
+def test_shift_example():
+    BD = torch.arange(-3., 3.).expand(1, 1, 3, 6)
+    assert shift(BD)[0, 0].tolist() == [[0, 1, 2], [-1, 0, 1], [-2, -1, 0]]
+
+
+@pytest.mark.parametrize('query_chunk', [0, 3])
+@pytest.mark.parametrize('with_ac', [False, True])
+def test_rel_term(query_chunk, with_ac):
+    attn = build_attn(query_chunk)
+    torch.manual_seed(1)
+    q = torch.randn(2, 4, 7, 8, requires_grad=True)
+    r = torch.randn(14, 8, requires_grad=True)
+    AC = torch.randn(2, 4, 7, 7)
+    grad = torch.randn(2, 4, 7, 7)
+    outs = []
+    for rel_term in [lambda *args: rel_term_shift(attn, *args), attn._rel_term]:
+        attn.zero_grad()
+        q.grad = r.grad = None
+        out = rel_term(q, r, AC.clone() if with_ac else None)
+        (out * grad).sum().backward()
+        outs.append([out, q.grad, r.grad, attn.r_w_bias.grad])
+    for ref, direct in zip(*outs):
+        torch.testing.assert_close(direct, ref, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('query_chunk', [0, 3])
+def test_padded_forward(query_chunk):
+    '''the full attention over a batch of lengths 7 and 4, the padded keys are masked'''
+    attn = build_attn(query_chunk)
+    seq_len = torch.tensor([7, 4])
+    valid = torch.arange(7)[None] < seq_len[:, None]
+    mask = valid[:, None, :].expand(2, 7, 7).long()  # as TransformerEncoderLayer masks the keys
+    torch.manual_seed(1)
+    x = torch.randn(2, 7, 32, requires_grad=True)
+    grad = torch.randn(2, 7, 32)
+    outs = []
+    for name in ['shift', 'direct']:
+        if name == 'shift':
+            attn.__dict__['_rel_term'] = lambda q, r, AC=None: rel_term_shift(attn, q, r, AC)
+        else:
+            attn.__dict__.pop('_rel_term')
+        attn.zero_grad()
+        x.grad = None
+        v, _ = attn(x, x, mask)
+        v = v.masked_fill(~valid[:, :, None], 0.)
+        (v * grad).sum().backward()
+        outs.append([v, x.grad] + [p.grad for p in attn.parameters()])
+    for ref, direct in zip(*outs):
+        torch.testing.assert_close(direct, ref, rtol=1e-5, atol=1e-5)
@@ -370,6 +370,10 @@ class Data:
         self.HP_batch_size = int(args.batch_size)
         self.average_batch_loss = str2bool(args.ave_batch_loss)
         self.seed = int(args.seed)
+        self.online_delay = int(args.online_delay)
+        self.online_revise = str2bool(args.online_revise)
+        self.train_stage = args.train_stage
+        self.stage1_dir = args.stage1_dir
 
         # word representation
         self.use_char = str2bool(args.use_char)
@@ -378,6 +382,13 @@ class Data:
         self.HP_char_hidden_dim = int(args.char_hidden_dim)
         self.word_emb_dim = int(args.word_emb_dim)
         self.HP_dropout = float(args.dropout)
+        self.share_wordrep = str2bool(args.share_wordrep)
+        self.varlen_encoder = str2bool(args.varlen_encoder)
+        self.attn_type = args.attn_type
+        self.attn_impl = args.attn_impl
+        self.early_exit = str2bool(args.early_exit)
+        self.early_exit_threshold = float(args.early_exit_threshold)
+        self.checkpoint_activations = str2bool(args.checkpoint_activations)
 
         # model1 parameter
         self.HP_bayesian_lstm_dropout = (float(args.bayesian_lstm_dropout), float(args.bayesian_lstm_dropout))
@@ -387,6 +398,15 @@ class Data:
         self.HP_bilstm = str2bool(args.bilstm)
         self.HP_nsamples = int(args.nsample)
         self.HP_threshold = float(args.threshold)
+        self.HP_uncertainty_mode = args.uncertainty_mode
+        self.HP_mc_adaptive = str2bool(args.mc_adaptive)
+        self.HP_mc_round = int(args.mc_round)
+        self.HP_mc_tol = float(args.mc_tol)
+        if self.HP_mc_adaptive and self.HP_mc_round < 1:
+            raise ValueError("--mc_round must be >= 1 with --mc_adaptive, got %d" % self.HP_mc_round)
+        if self.HP_mc_adaptive and self.HP_mc_tol <= 0:
+            raise ValueError("--mc_tol must be > 0 with --mc_adaptive, got %s" % self.HP_mc_tol)
+        self.HP_mc_chunk = int(args.mc_chunk)
 
         # model2 parameter
         self.HP_label_embed_dim = int(args.label_embed_dim)
@@ -401,7 +421,10 @@ class Data:
 
         self.use_memory = str2bool(args.use_memory)
         self.HP_max_read_memory = int(args.max_read_memory)
+        self.HP_memory_topk = int(args.memory_topk)
         self.HP_memory_attn_nhead = int(args.memory_attn_nhead)
+        self.HP_corpus_memory_size = int(args.corpus_memory_size)
+        self.HP_corpus_memory_evict = args.corpus_memory_evict
         self.use_crf = str2bool(args.use_crf)
 
         # optimizer
@@ -416,6 +439,15 @@ class Data:
         self.warmup_step = float(args.warmup_step)
         self.HP_lr2 = float(args.learning_rate2)
 
+        # inference
+        self.compile_mode = args.compile
+
+        # cpu
+        self.num_threads = int(args.num_threads)
+        self.num_interop_threads = int(args.num_interop_threads)
+        self.cpu_affinity = parse_cpu_list(args.cpu_affinity) if args.cpu_affinity else None
+        self.telemetry_path = args.telemetry
+
 
 
 
@@ -457,6 +489,23 @@ def config_file_to_dict(input_file):
     return config
 
 
+def parse_cpu_list(cpu_list):
+    '''
+    parse a cpu list like "0-3,8" into {0, 1, 2, 3, 8}
+    '''
+    cpus = set()
+    for item in str(cpu_list).split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            begin, end = item.split('-', 1)
+            cpus.update(range(int(begin), int(end) + 1))
+        else:
+            cpus.add(int(item))
+    return cpus
+
+
 def str2bool(str):
     if type(str) is bool: return str
     if str == "True" or str == "true" or str == "TRUE":
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the per-token stage-1 outputs (p and lstm_out) of every document, stored as memory-mapped .npy files.
+
+Tokens are addressed by (doc_idx, word_idx): word_idx restarts at 1 in every document, so the row of a token is the
+number of words in the previous documents plus word_idx - 1.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+
+import numpy as np
+import torch
+
+
+class Stage1Cache(object):
+    def __init__(self, cache_dir, word_mat, mode='r', num_labels=None, hidden_dim=None):
+        '''
+        :param cache_dir: directory of the cache files
+        :param word_mat: Data.word_mat, one (number of words + 1) x max_read_memory matrix per document
+        :param mode: 'r' to read an existing cache, 'w' to create it (requires num_labels and hidden_dim)
+        '''
+        self.cache_dir = cache_dir
+        doc_words = np.array([m.shape[0] - 1 for m in word_mat], dtype=np.int64)
+        self.doc_start = np.concatenate([[0], np.cumsum(doc_words)[:-1]]).astype(np.int64)
+        total = int(doc_words.sum())
+
+        p_file = os.path.join(cache_dir, "p.npy")
+        h_file = os.path.join(cache_dir, "lstm_out.npy")
+        words_file = os.path.join(cache_dir, "doc_words.npy")
+        if mode == 'w':
+            if not os.path.exists(cache_dir):
+                os.mkdir(cache_dir)
+            np.save(words_file, doc_words)
+            self.p = np.lib.format.open_memmap(p_file, mode='w+', dtype=np.float32, shape=(total, num_labels))
+            self.lstm_out = np.lib.format.open_memmap(h_file, mode='w+', dtype=np.float32, shape=(total, hidden_dim))
+        else:
+            if not np.array_equal(np.load(words_file), doc_words):
+                raise ValueError("stage-1 cache in %s was built from different documents" % cache_dir)
+            self.p = np.load(p_file, mmap_mode='r')
+            self.lstm_out = np.load(h_file, mmap_mode='r')
+
+    def rows(self, doc_idx, word_idx, mask):
+        '''
+        :param doc_idx: (batch_size, )
+        :param word_idx: (batch_size, max_seq_len)
+        :param mask: (batch_size, max_seq_len)
+        :return: cache rows of the unmasked tokens, in row-major order of `mask`
+        '''
+        doc_idx = doc_idx.cpu().numpy()
+        word_idx = word_idx.cpu().numpy()
+        mask = mask.cpu().numpy().astype(bool)
+        return (self.doc_start[doc_idx][:, None] + word_idx - 1)[mask]
+
+    def put(self, doc_idx, word_idx, mask, p, lstm_out):
+        rows = self.rows(doc_idx, word_idx, mask)
+        mask = mask.bool()
+        self.p[rows] = p[mask].cpu().numpy()
+        self.lstm_out[rows] = lstm_out[mask].cpu().numpy()
+
+    def get(self, doc_idx, word_idx, mask):
+        '''
+        :return: p (batch_size, max_seq_len, num_labels), lstm_out (batch_size, max_seq_len, hidden_dim),
+            zeros at the masked positions, on the device of `mask`
+        '''
+        rows = self.rows(doc_idx, word_idx, mask)
+        mask = mask.bool()
+        batch_size, max_seq_len = mask.size()
+        p = torch.zeros(batch_size, max_seq_len, self.p.shape[1], device=mask.device)
+        lstm_out = torch.zeros(batch_size, max_seq_len, self.lstm_out.shape[1], device=mask.device)
+        p[mask] = torch.from_numpy(np.ascontiguousarray(self.p[rows])).to(mask.device)
+        lstm_out[mask] = torch.from_numpy(np.ascontiguousarray(self.lstm_out[rows])).to(mask.device)
+        return p, lstm_out
+
+    def flush(self):
+        self.p.flush()
+        self.lstm_out.flush()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Per-step timing of training / decoding phases, written as one JSON object per line.
+
+Instrumented code wraps a phase with `with phase('name'):` and the loop calls `begin_step()` / `end_step(...)`
+around each batch. All calls are no-ops until `enable()` is called.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+import json
+import sys
+import time
+from collections import OrderedDict
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+_telemetry = None
+
+
+class Telemetry(object):
+    def __init__(self, path, gpu):
+        self.out = open(path, 'a')
+        self.gpu = gpu
+        self.phases = OrderedDict()
+        self.step_start = None
+
+    def sync(self):
+        if self.gpu:
+            torch.cuda.synchronize()
+
+    def begin_step(self):
+        self.sync()
+        self.phases = OrderedDict()
+        self.step_start = time.time()
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.) + seconds
+
+    def end_step(self, tokens=0, **fields):
+        self.sync()
+        step_time = time.time() - self.step_start
+        record = OrderedDict([('time', time.time())])
+        record.update(fields)
+        record['tokens'] = tokens
+        record['step_time'] = step_time
+        record['tokens_per_s'] = tokens / step_time if step_time > 0 else 0.
+        record['phases'] = self.phases
+        record['peak_rss_mb'] = peak_rss_mb()
+        if self.gpu:
+            record['peak_gpu_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _telemetry is not None:
+            _telemetry.sync()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if _telemetry is not None and self.start is not None:
+            _telemetry.sync()
+            _telemetry.add(self.name, time.time() - self.start)
+        return False
+
+
+def enable(path, gpu=False):
+    global _telemetry
+    _telemetry = Telemetry(path, gpu)
+    print("Write per-step telemetry to %s" % path)
+
+
+def phase(name):
+    return Phase(name)
+
+
+def begin_step():
+    if _telemetry is not None:
+        _telemetry.begin_step()
+
+
+def end_step(tokens=0, **fields):
+    if _telemetry is not None:
+        _telemetry.end_step(tokens, **fields)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes on macOS, kilobytes on linux
+        return peak / 2 ** 20
+    return peak / 2 ** 10